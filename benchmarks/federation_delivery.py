@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Benchmark of delivering one envelope to 500 recipients spread over 100 pods,
+comparing sending to one recipient at a time (as DiasporaPost.send_to used
+to) against pyaspora.diaspora.delivery.deliver_all().
+
+Each pod is a local stand-in server that accepts Salmon POSTs after a fixed
+delay, standing in for network and processing latency. It also records the
+most deliveries it saw in progress at once, to check the per-host limit.
+
+Run from the top of the source tree (Python 3.7 or above):
+
+    python benchmarks/federation_delivery.py [recipients] [pods] [latency-ms]
+
+No database is needed.
+"""
+from __future__ import print_function
+
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import sleep, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pyaspora import app  # noqa
+from pyaspora.diaspora.delivery import deliver_all, send_envelope  # noqa
+
+
+class StandInPod(ThreadingHTTPServer):
+    """
+    A local server that accepts anything POSTed to it after <latency>
+    seconds.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), _PodHandler)
+        self.latency = latency
+        self.lock = Lock()
+        self.in_progress = 0
+        self.max_in_progress = 0
+        self.received = 0
+        Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/'.format(self.server_port)
+
+
+class _PodHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        pod = self.server
+        with pod.lock:
+            pod.in_progress += 1
+            pod.max_in_progress = max(pod.max_in_progress, pod.in_progress)
+        try:
+            self.rfile.read(int(self.headers['Content-Length']))
+            sleep(pod.latency)
+        finally:
+            with pod.lock:
+                pod.in_progress -= 1
+                pod.received += 1
+        self.send_response(202)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'OK')
+
+
+def run(recipients, pod_count, latency):
+    pods = [StandInPod(latency) for _ in range(pod_count)]
+    envelope = b'<?xml version="1.0"?><diaspora>' + b'x' * 4096 + \
+        b'</diaspora>'
+    deliveries = [
+        (i, '{0}receive/users/{1}'.format(pods[i % pod_count].url, i),
+         envelope)
+        for i in range(recipients)
+    ]
+
+    start = time()
+    results = [send_envelope(app, *d) for d in deliveries]
+    one_at_a_time = time() - start
+    sent = len([r for r in results if r.sent])
+    print('one at a time: {0:6.2f}s, {1} of {2} sent'.format(
+        one_at_a_time, sent, recipients
+    ))
+
+    for pod in pods:
+        pod.max_in_progress = 0
+    start = time()
+    results = deliver_all(deliveries)
+    concurrent = time() - start
+    sent = len([r for r in results if r.sent])
+    print('  deliver_all: {0:6.2f}s, {1} of {2} sent'.format(
+        concurrent, sent, recipients
+    ))
+    print('     speed-up: {0:.1f}x'.format(one_at_a_time / concurrent))
+    print('most in progress at one pod: {0} (DELIVERY_PER_HOST is {1})'.format(
+        max(p.max_in_progress for p in pods),
+        app.config.get('DELIVERY_PER_HOST', 2)
+    ))
+
+    for pod in pods:
+        pod.shutdown()
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        run(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 500,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 100,
+            (int(sys.argv[3]) if len(sys.argv) > 3 else 20) / 1000.0
+        )
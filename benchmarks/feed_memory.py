@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Memory benchmark of loading a feed page of image-heavy posts, and a roster of
+contacts with avatars. It compares loading MimePart bodies eagerly (as
+before MimePart.body was deferred) against the default deferred loading.
+
+Run from the top of the source tree (Python 3.4 or above, for tracemalloc):
+
+    python benchmarks/feed_memory.py [posts] [image-kilobytes]
+
+An in-memory SQLite database is used.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy.orm import undefer  # noqa
+
+from pyaspora import app  # noqa
+from pyaspora.contact.models import Contact  # noqa
+from pyaspora.content.models import MimePart  # noqa
+from pyaspora.database import db  # noqa
+from pyaspora.post.models import Post, PostPart, Share  # noqa
+from pyaspora.post.views import json_posts  # noqa
+
+
+def populate(posts, image_size):
+    image = os.urandom(image_size)
+    contacts = []
+    for i in range(posts):
+        contact = Contact(
+            realname='Contact {0}'.format(i),
+            public_key='-',
+            avatar=MimePart(type='image/png', body=image,
+                            text_preview='(avatar)')
+        )
+        db.session.add(contact)
+        contacts.append(contact)
+
+        post = Post(author=contact)
+        db.session.add(post)
+        db.session.add(PostPart(post=post, order=0, inline=True,
+                                mime_part=MimePart(type='text/plain',
+                                                   body=b'Look at this')))
+        db.session.add(PostPart(post=post, order=1, inline=True,
+                                mime_part=MimePart(type='image/png',
+                                                   body=image,
+                                                   text_preview='(picture)')))
+        db.session.add(Share(contact=contact, post=post, public=True))
+    db.session.commit()
+    return [p.id for p in db.session.query(Post)], [c.id for c in contacts]
+
+
+def measure(label, fn):
+    db.session.expunge_all()
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    print('{0:>30}: {1:10.1f} KiB peak'.format(label, peak / 1024.0))
+
+
+def run(posts, image_size):
+    post_ids, contact_ids = populate(posts, image_size)
+
+    def parts(eager):
+        query = PostPart.get_parts_for_posts(post_ids)
+        if eager:
+            query = query.options(undefer('mime_part._body'))
+        query.all()
+
+    def roster(eager):
+        query = Contact.get_many(contact_ids)
+        if eager:
+            query = query.options(undefer('avatar._body'))
+        query.all()
+
+    def feed_page():
+        json_posts([(p, None) for p in
+                    db.session.query(Post).filter(Post.id.in_(post_ids))])
+
+    measure('feed parts, eager bodies', lambda: parts(True))
+    measure('feed parts, deferred bodies', lambda: parts(False))
+    measure('roster, eager avatars', lambda: roster(True))
+    measure('roster, deferred avatars', lambda: roster(False))
+    measure('json_posts, deferred bodies', feed_page)
+
+
+if __name__ == '__main__':
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    with app.test_request_context('/?alt=json'):
+        db.create_all()
+        run(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 25,
+            1024 * (int(sys.argv[2]) if len(sys.argv) > 2 else 512)
+        )
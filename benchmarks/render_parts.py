@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of rendering a single post part, comparing the renderer
+templates compiled once (pyaspora.content.rendering.Template) against
+render_template_string, which compiles the template on every call.
+
+Run from the top of the source tree:
+
+    python benchmarks/render_parts.py [iterations]
+
+No database is needed; the parts are built in memory.
+"""
+from __future__ import print_function
+
+import os
+import sys
+from json import dumps
+from timeit import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import render_template_string  # noqa
+
+from pyaspora import app  # noqa
+from pyaspora.content import rendering  # noqa
+
+
+class FakeMimePart(object):
+    def __init__(self, part_id, mime_type, body, text_preview=None):
+        self.id = part_id
+        self.type = mime_type
+        self.body = body.encode('utf-8')
+        self.text_preview = text_preview
+
+
+class FakePostPart(object):
+    def __init__(self, mime_part, inline=True):
+        self.mime_part = mime_part
+        self.mime_part_id = mime_part.id
+        self.inline = inline
+
+
+PARTS = [
+    FakePostPart(FakeMimePart(1, 'text/plain', u'Hello\nworld')),
+    FakePostPart(FakeMimePart(2, 'image/png', u'', u'(picture)')),
+    FakePostPart(FakeMimePart(3, 'application/x-pyaspora-subscribe', dumps({
+        'to': 1, 'to_name': 'Someone'
+    }))),
+    FakePostPart(FakeMimePart(4, 'application/x-pyaspora-share', dumps({
+        'author': {'id': 1, 'name': 'Someone'}
+    }))),
+    FakePostPart(FakeMimePart(5, 'application/x-diaspora-poll-question',
+                              u'Tea or coffee?')),
+    FakePostPart(FakeMimePart(6, 'application/x-diaspora-poll-answer',
+                              u'Tea')),
+    FakePostPart(FakeMimePart(7, 'application/octet-stream', u'',
+                              u'file.bin'), inline=False),
+]
+
+
+def _compile_every_time(template, **context):
+    return render_template_string(template.source, **context)
+
+
+def _compiled_once(template, **context):
+    return template.render(**context)
+
+
+def run(iterations):
+    def per_part():
+        for part in PARTS:
+            rendering._render(part, 'text/html', 'http://example.com/raw')
+            rendering._render(part, 'text/plain', 'http://example.com/raw')
+
+    results = {}
+    original = rendering.Template.render
+    for label, fn in (('before', _compile_every_time),
+                      ('after', _compiled_once)):
+        rendering.Template.render = \
+            lambda self, _fn=fn, **ctx: _fn(self, **ctx)
+        try:
+            per_part()  # warm up
+            elapsed = timeit(per_part, number=iterations)
+        finally:
+            rendering.Template.render = original
+        results[label] = elapsed / (iterations * len(PARTS) * 2) * 1e6
+
+    for label in ('before', 'after'):
+        print('{0:>6}: {1:8.1f} us per part rendering'.format(
+            label, results[label]
+        ))
+    print('speed-up: {0:.1f}x'.format(results['before'] / results['after']))
+
+
+if __name__ == '__main__':
+    with app.test_request_context():
+        run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
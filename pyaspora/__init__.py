@@ -3,6 +3,7 @@ from __future__ import absolute_import
 from flask import Flask, url_for
 
 from pyaspora.database import db
+from pyaspora.content.storage import UploadRequest
 from pyaspora.content.views import blueprint as content_blueprint
 from pyaspora.contact.views import blueprint as contacts_blueprint
 from pyaspora.diaspora.views import blueprint as diaspora_blueprint
@@ -14,6 +15,7 @@ from pyaspora.user.views import blueprint as users_blueprint
 from pyaspora.utils import templates
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 db.init_app(app)
 
 # Global configuration
@@ -0,0 +1,146 @@
+"""
+Maintenance commands that are run outside of a web request, for example to
+back-fill data after an upgrade. Run them from quickstart.py with:
+
+    ./quickstart.py <command> [args...]
+"""
+from __future__ import absolute_import
+
+from time import sleep
+
+from pyaspora import app
+
+commands = {}
+
+
+def command(name):
+    """
+    Decorator which registers a function as the maintenance command <name>.
+    """
+    def _inner(fn):
+        commands[name] = fn
+        return fn
+    return _inner
+
+
+def run_command(name, *args):
+    """
+    Run the maintenance command <name> inside an application context.
+    """
+    if name not in commands:
+        raise SystemExit('Unknown command {0}. Choose from: {1}'.format(
+            name, ', '.join(sorted(commands.keys()))
+        ))
+    with app.test_request_context():
+        return commands[name](*args)
+
+
+def _add_column(table, column, definition, index=False):
+    """
+    Add column <column> to <table> with SQL type and constraints
+    <definition>, if it's not there already, for upgrading existing
+    databases.
+    """
+    from sqlalchemy import inspect
+    from pyaspora.database import db
+    columns = [c['name'] for c in inspect(db.engine).get_columns(table)]
+    if column not in columns:
+        db.engine.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+            table, column, definition
+        ))
+        if index:
+            db.engine.execute('CREATE INDEX ix_{0}_{1} ON {0} ({1})'.format(
+                table, column
+            ))
+
+
+@command('init_db')
+def create_tables():
+    """
+    Create any missing database tables.
+    """
+    from pyaspora import init_db
+    init_db()
+
+
+@command('rebuild_feeds')
+def rebuild_feeds():
+    """
+    (Re-)build the materialised feed for every local user.
+    """
+    from pyaspora.feed.models import FeedItem
+    FeedItem.rebuild_all()
+
+
+@command('add_feed_change_times')
+def add_feed_change_times():
+    """
+    Add the feed_items.changed_at column if it is missing.
+    """
+    _add_column('feed_items', 'changed_at', 'TIMESTAMP WITH TIME ZONE',
+                index=True)
+
+
+@command('add_post_roots')
+def add_post_roots():
+    """
+    Add the posts.root_id column if it is missing, and fill it in for existing
+    comments.
+    """
+    from pyaspora.post.models import Post
+    _add_column('posts', 'root_id', 'INTEGER REFERENCES posts(id)',
+                index=True)
+    print('Updated {0} posts'.format(Post.backfill_roots()))
+
+
+@command('rerender_parts')
+def rerender_parts():
+    """
+    Re-render and store every post part, eg. after changing a renderer.
+    """
+    from pyaspora.content.rendering import rebuild_renderings
+    print('Rendered {0} parts'.format(rebuild_renderings()))
+
+
+@command('add_body_hashes')
+def add_body_hashes():
+    """
+    Add the mime_parts.body_hash, mime_parts.storage and
+    mime_parts.created_at columns if they are missing, and fill in the hash
+    and creation time of existing parts.
+    """
+    from pyaspora.content.models import MimePart
+    _add_column('mime_parts', 'body_hash', 'VARCHAR(64)', index=True)
+    _add_column('mime_parts', 'storage', 'VARCHAR')
+    _add_column('mime_parts', 'created_at', 'TIMESTAMP WITH TIME ZONE')
+    print('Hashed {0} parts'.format(MimePart.backfill_hashes()))
+
+
+@command('move_bodies')
+def move_bodies():
+    """
+    Move post part bodies out of the database into the BLOB_FOLDER store.
+    """
+    from pyaspora.content.storage import move_bodies
+    add_body_hashes()
+    print('Moved {0} parts'.format(move_bodies()))
+
+
+@command('deliver_queue')
+def deliver_queue(once=None):
+    """
+    Send queued messages to remote nodes, DELIVERY_WORKERS at a time, and
+    keep polling for more unless run as "deliver_queue once".
+    """
+    from pyaspora.diaspora.delivery import deliver_pending
+    interval = app.config.get('DELIVERY_POLL_INTERVAL', 5)
+    while True:
+        sent, failed, deferred = deliver_pending()
+        if sent or failed or deferred:
+            print('Sent {0} messages, {1} failed, {2} deferred'.format(
+                sent, failed, deferred
+            ))
+        if once:
+            break
+        if not (sent or failed):
+            sleep(interval)
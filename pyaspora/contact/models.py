@@ -83,6 +83,8 @@ class Contact(db.Model):
             Subscribe.send(self.user, contact)
             Profile.send(self.user, contact)
         self.notify_subscribe(contact)
+        if self.user:
+            self.rebuild_feed()
 
     def unsubscribe(self, contact):
         """
@@ -98,6 +100,16 @@ class Contact(db.Model):
             db.session.delete(sub)
         if not contact.user:
             Unsubscribe.send(self.user, contact)
+        if self.user:
+            self.rebuild_feed()
+
+    def rebuild_feed(self):
+        """
+        The people or topics that this local Contact follows have changed, so
+        recalculate which posts appear in their feed.
+        """
+        from pyaspora.feed.models import FeedItem
+        FeedItem.rebuild_for_contact(self)
 
     def notify_subscribe(self, contact):
         """
@@ -62,7 +62,13 @@ Display a contact's "wall", which varies according to who is viewing it.
 <h3>News</h3>
 
 {% if feed %}
+    {% if actions.newer %}
+        {{button_form(actions.newer, 'View newer items', method='get')}}
+    {% endif %}
     {{show_feed(feed)}}
+    {% if actions.more %}
+        {{button_form(actions.more, 'View older items', method='get')}}
+    {% endif %}
 {% else %}
     <p>No news to show.</p>
 {% endif %}
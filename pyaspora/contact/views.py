@@ -14,14 +14,15 @@ from lxml import etree
 from re import match as re_match
 from traceback import format_exc
 from sqlalchemy.orm import contains_eager
-from sqlalchemy.sql import desc, or_
+from sqlalchemy.sql import or_
 
 from pyaspora.contact.models import Contact
 from pyaspora.database import db
 from pyaspora.tag.views import json_tag
 from pyaspora.utils import get_server_name
+from pyaspora.utils.pagination import keyset_page, page_actions
 from pyaspora.utils.rendering import abort, add_logged_in_user_to_data, \
-    raw_response, redirect, render_response, send_xml
+    redirect, render_response, send_xml
 from pyaspora.user.session import logged_in_user, require_logged_in_user
 
 blueprint = Blueprint('contacts', __name__, template_folder='templates')
@@ -49,13 +50,13 @@ def avatar(contact_id):
     if not part:
         abort(404, 'Contact has no avatar', force_status=True)
 
-    return raw_response(part.body, part.type, expiry_delta=timedelta(hours=12))
+    return part.body_response(expiry_delta=timedelta(hours=12))
 
 
-def _profile_base(contact_id, public=False):
+def _profile_base(contact_id, public=False, formats=None):
     """
     Standard data for profile-alike pages, including the profile page and feed
-    pages.
+    pages. <formats> is passed on to json_posts().
     """
     from pyaspora.post.models import Post, Share
     from pyaspora.post.views import json_posts
@@ -89,12 +90,24 @@ def _profile_base(contact_id, public=False):
         feed = db.session.query(Share). \
             join(Post). \
             filter(feed_query). \
-            order_by(desc(Post.thread_modified_at)). \
             group_by(Post.id). \
-            options(contains_eager(Share.post)). \
-            limit(limit)
-
-        data['feed'] = json_posts([(s.post, s) for s in feed], viewing_as)
+            options(contains_eager(Share.post))
+        feed = keyset_page(feed, Post.Queries.thread_sort_key(), Post.id,
+                           limit)
+
+        data['feed'] = json_posts(
+            [(s.post, s) for s in feed],
+            viewing_as,
+            formats=formats
+        )
+        data['actions'].update(page_actions(
+            request.endpoint,
+            feed,
+            lambda s: (s.post.thread_sort_time, s.post.id),
+            limit,
+            contact_id=contact.id,
+            public=request.args.get('public')
+        ))
 
     add_logged_in_user_to_data(data, viewing_as)
     return data, contact
@@ -122,7 +135,7 @@ def feed(contact_id):
     An Atom feed of public events for the contact. Only available for contacts
     who are local to this server.
     """
-    data, contact = _profile_base(contact_id, public=True)
+    data, contact = _profile_base(contact_id, public=True, formats=('text',))
     if not(contact.user and contact.user.activated):
         flask_abort(404, 'No such user')
 
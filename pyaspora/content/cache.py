@@ -0,0 +1,88 @@
+"""
+A cache of rendered MimeParts, so that a part's body (for example, Markdown)
+is only rendered once rather than every time a Post containing it is shown.
+
+Rendered output depends only on the MimePart, the output format and whether
+the part is displayed inline; it never depends on who is viewing it, or on
+the host they reached the server by (links to this server are cached with a
+placeholder for the host, see render_portable()). Entries
+are kept in an in-process LRU of RENDER_CACHE_SIZE entries. If
+RENDER_CACHE_BACKEND is configured with an object offering get(key),
+set(key, value) and delete(key) (for example, a werkzeug.contrib.cache cache)
+then rendered output is also stored there, so that it survives restarts and
+is shared between processes.
+"""
+from __future__ import absolute_import
+
+from sqlalchemy import event
+
+from pyaspora.content.models import MimePart
+from pyaspora.utils.cache import LRUCache
+
+DEFAULT_SIZE = 10000
+FORMATS = ('text/plain', 'text/html')
+
+
+class RenderCache(LRUCache):
+    """
+    LRU cache of rendered part bodies, keyed on (MimePart ID, format, inline).
+    """
+
+    def __init__(self):
+        super(RenderCache, self).__init__('RENDER_CACHE_SIZE', DEFAULT_SIZE)
+
+    def _backend(self):
+        return self._config('RENDER_CACHE_BACKEND', None)
+
+    def _backend_key(self, key):
+        return 'render:{0}:{1}:{2}'.format(*key)
+
+    def get(self, key):
+        """
+        Return a 1-tuple of the cached rendering for <key>, or None if it has
+        not been cached. (The rendering itself may be None.)
+        """
+        entry = super(RenderCache, self).get(key)
+        backend = self._backend()
+        if entry is None and backend is not None:
+            entry = backend.get(self._backend_key(key))
+            if entry is not None:
+                super(RenderCache, self).put(key, entry[0])
+        return entry
+
+    def prime(self, key, rendered):
+        """
+        Cache <rendered> as the rendering for <key> in this process only, for
+        renderings that are already stored elsewhere.
+        """
+        super(RenderCache, self).put(key, rendered)
+
+    def put(self, key, rendered):
+        """
+        Cache <rendered> as the rendering for <key>.
+        """
+        super(RenderCache, self).put(key, rendered)
+        backend = self._backend()
+        if backend is not None:
+            backend.set(self._backend_key(key), (rendered,))
+
+    def invalidate(self, mime_part_id):
+        """
+        Discard the renderings of MimePart ID <mime_part_id>.
+        """
+        self.discard(lambda k: k[0] == mime_part_id)
+        backend = self._backend()
+        if backend is not None:
+            for fmt in FORMATS:
+                for inline in (True, False):
+                    backend.delete(
+                        self._backend_key((mime_part_id, fmt, inline))
+                    )
+
+
+render_cache = RenderCache()
+
+
+@event.listens_for(MimePart, 'after_update')
+def _invalidate_part(mapper, connection, part):
+    render_cache.invalidate(part.id)
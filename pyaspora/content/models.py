@@ -1,7 +1,12 @@
 from __future__ import absolute_import
 
-from sqlalchemy import Column, Integer, LargeBinary, String
+from hashlib import sha256
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, \
+    LargeBinary, String, Text
+from sqlalchemy.orm import deferred, synonym, undefer
+from sqlalchemy.sql.expression import func
 
+from pyaspora.content.storage import blob_store, spool_upload
 from pyaspora.database import db
 
 
@@ -13,15 +18,85 @@ class MimePart(db.Model):
     Fields:
         id - an integer identifier uniquely identifying this group in the node
         type - the MIME type (eg. "text/plain") of the body
-        body - the raw content blob
+        body - the raw content blob. This can be large, so is only loaded
+               when it's used (or explicitly with load_bodies())
+        body_hash - the hex SHA-256 hash of the body
+        storage - where the body is kept (see pyaspora.content.storage), or
+                  None if it is in the database
         text_preview - plain text that can be displayed in lieu of content if
                        the body cannot be displayed
+        created_at - when the part was stored
     """
     __tablename__ = 'mime_parts'
     id = Column(Integer, primary_key=True)
     type = Column(String, nullable=False)
-    body = Column(LargeBinary, nullable=False)
+    _body = deferred(Column('body', LargeBinary, nullable=False))
+    body_hash = Column(String(64), nullable=True, index=True)
+    storage = Column(String, nullable=True)
     text_preview = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=True,
+                        default=func.now())
+
+    def _get_body(self):
+        if self.storage:
+            return blob_store(self.storage).load(self.body_hash)
+        return self._body
+
+    def _set_body(self, body):
+        self.body_hash = sha256(body).hexdigest()
+        store = blob_store()
+        if store:
+            store.save(self.body_hash, body)
+            self.storage = store.name
+            self._body = b''
+        else:
+            self.storage = None
+            self._body = body
+
+    body = synonym('_body', descriptor=property(_get_body, _set_body))
+
+    def set_body_from_stream(self, stream):
+        """
+        Set the body to the content of the file-like <stream> (eg. an
+        upload). If bodies are kept in files, the content is spooled to disk
+        rather than read into memory.
+        """
+        store = blob_store()
+        if not store:
+            self.body = stream.read()  # The database needs it all at once
+            return
+        path, digest = spool_upload(stream)
+        store.save_file(digest, path)
+        self.body_hash = digest
+        self.storage = store.name
+        self._body = b''
+
+    def body_path(self):
+        """
+        The filename the body is stored in, or None if it is kept in the
+        database.
+        """
+        if self.storage:
+            return blob_store(self.storage).path(self.body_hash)
+        return None
+
+    def body_response(self, expiry_delta=None):
+        """
+        A response serving the body, honouring conditional and Range
+        requests. Bodies kept in files are streamed from disk.
+        """
+        from pyaspora.utils.rendering import blob_response
+        path = self.body_path()
+        if path:
+            return blob_response(self.type, self.body_hash, path=path,
+                                 expiry_delta=expiry_delta)
+        # Parts stored before hashes were recorded get one from
+        # add_body_hashes, but until then it has to be worked out each time
+        etag = self.body_hash or sha256(self.body).hexdigest()
+        return blob_response(self.type, etag,
+                             body=lambda: self.body,
+                             expiry_delta=expiry_delta,
+                             last_modified=self.created_at)
 
     @classmethod
     def get(cls, part_id):
@@ -30,3 +105,77 @@ class MimePart(db.Model):
         doesn't exist.
         """
         return db.session.query(cls).get(part_id)
+
+    @classmethod
+    def backfill_hashes(cls, batch_size=100):
+        """
+        Fill in body_hash for parts stored before it was recorded, and
+        created_at from the earliest Post using each part. Returns the number
+        of parts hashed.
+        """
+        from pyaspora.post.models import Post, PostPart
+
+        first_used = db.session.query(func.min(Post.created_at)). \
+            join(PostPart). \
+            filter(PostPart.mime_part_id == cls.id). \
+            correlate(cls).as_scalar()
+        db.session.query(cls).filter(cls.created_at == None). \
+            update({cls.created_at: first_used}, synchronize_session=False)
+        db.session.commit()
+
+        part_ids = [r[0] for r in db.session.query(cls.id).
+                    filter(cls.body_hash == None)]
+        for start in range(0, len(part_ids), batch_size):
+            batch = part_ids[start:start + batch_size]
+            for part_id, body in db.session.query(cls.id, cls._body). \
+                    filter(cls.id.in_(batch)):
+                db.session.query(cls).filter(cls.id == part_id).update(
+                    {cls.body_hash: sha256(body).hexdigest()},
+                    synchronize_session=False
+                )
+            db.session.commit()
+        return len(part_ids)
+
+    @classmethod
+    def load_bodies(cls, part_ids):
+        """
+        Load the bodies of the MimeParts with IDs <part_ids> in one query,
+        rather than one query per part as each body is used.
+        """
+        if part_ids:
+            db.session.query(cls). \
+                filter(cls.id.in_(part_ids)). \
+                options(undefer(cls._body)). \
+                all()
+
+
+class RenderedPart(db.Model):
+    """
+    A MimePart rendered into an output format when it was stored, so that it
+    doesn't have to be rendered every time it is displayed. See
+    pyaspora.content.rendering.store_rendering().
+
+    Fields:
+        mime_part - the MimePart that was rendered
+        mime_part_id - the database primary key for the above
+        format - the MIME type it was rendered to, eg. 'text/html'
+        inline - whether the part was rendered for display inline
+        body - the rendering, which may be None if the part cannot be
+               rendered into <format>
+    """
+    __tablename__ = 'rendered_parts'
+    mime_part_id = Column(Integer, ForeignKey('mime_parts.id'),
+                          primary_key=True)
+    format = Column(String, primary_key=True)
+    inline = Column(Boolean, primary_key=True)
+    body = Column(Text, nullable=True)
+
+    @classmethod
+    def get_for_parts(cls, mime_part_ids):
+        """
+        Fetch all the stored renderings of the MimeParts with IDs
+        <mime_part_ids>.
+        """
+        return db.session.query(cls).filter(
+            cls.mime_part_id.in_(mime_part_ids)
+        )
@@ -1,6 +1,6 @@
 from __future__ import absolute_import
 
-from flask import render_template_string, url_for
+from flask import current_app
 from json import loads
 from markdown import Markdown
 try:
@@ -9,8 +9,15 @@ except:
     from markdown import Extension
 from markdown.preprocessors import Preprocessor
 from re import UNICODE, compile as re_compile
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from threading import local
 
-from pyaspora.utils.rendering import ACCEPTABLE_BROWSER_IMAGE_FORMATS
+from pyaspora.content.cache import FORMATS, render_cache
+from pyaspora.content.models import MimePart, RenderedPart
+from pyaspora.database import db
+from pyaspora.utils.rendering import ACCEPTABLE_BROWSER_IMAGE_FORMATS, \
+    localise_urls, portable_url
 
 renderers = {}
 
@@ -33,23 +40,112 @@ class SkipTagsExtension(Extension):
         md.preprocessors.add('skiptags', self.SkipTagPattern(), '_end')
 
 
-def _markdown_to_html(md_text):
-    common_opts = dict(
-        output_format='xhtml',
-        safe_mode='replace',
-        extensions=['headerid(forceid=False, level=3)', SkipTagsExtension()]
-    )
-    try:
-        md = Markdown(
-            html_replacement_text='(could not show this)',
-            lazy_ol=False,
-            **common_opts
-        )
-    except TypeError:
-        md = Markdown(
-            **common_opts
+_engines = local()
+
+
+def _markdown_engine():
+    """
+    The Markdown converter for this thread. Setting up Markdown and its
+    extensions is much more expensive than converting a short post, so each
+    thread keeps one and resets it between conversions.
+    """
+    md = getattr(_engines, 'markdown', None)
+    if md is None:
+        common_opts = dict(
+            output_format='xhtml',
+            safe_mode='replace',
+            extensions=[
+                'headerid(forceid=False, level=3)',
+                SkipTagsExtension()
+            ]
         )
-    return md.convert(md_text)
+        try:
+            md = Markdown(
+                html_replacement_text='(could not show this)',
+                lazy_ol=False,
+                **common_opts
+            )
+        except TypeError:
+            md = Markdown(
+                **common_opts
+            )
+        _engines.markdown = md
+    return md
+
+
+def markdown_to_html_many(md_texts):
+    """
+    Convert each of the Markdown strings <md_texts> to HTML, returning a list
+    of the results in the same order.
+    """
+    md = _markdown_engine()
+    ret = []
+    for md_text in md_texts:
+        try:
+            ret.append(md.convert(md_text))
+        finally:
+            md.reset()
+    return ret
+
+
+def _markdown_to_html(md_text):
+    return markdown_to_html_many([md_text])[0]
+
+
+class Template(object):
+    """
+    A constant Jinja template, which is compiled the first time it is used
+    rather than every time it is rendered (as render_template_string would).
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.compiled = None
+
+    def render(self, **context):
+        """
+        Render the template with variables <context>.
+        """
+        env = current_app.jinja_env
+        compiled = self.compiled
+        if compiled is None or compiled[0] is not env:
+            compiled = self.compiled = (env, env.from_string(self.source))
+        return compiled[1].render(**context)
+
+
+_TEXT_AS_HTML = Template('{{text|nl2br}}')
+_IMAGE = Template('<img src="{{url}}" alt="{{alt}}" />')
+_SUBSCRIBED = Template('subscribed to <a href="{{profile}}">{{name}}</a>')
+_SHARED = Template("shared <a href='{{profile}}'>{{name}}</a>'s post")
+_POLL_QUESTION = Template("Question: <strong>{{question}}</strong>")
+_POLL_ANSWER = Template("<ul style='margin: 0em'><li>{{question}}</li></ul>")
+_POLL_PARTICIPATION = Template("answered with <strong>{{answer}}</strong>")
+_PREVIEW = Template('{{t}}')
+_LINK_AS_HTML = Template('<a href="{{u}}">(link)</a>')
+_LINK_AS_TEXT = Template('Link: {{u}}')
+_PROFILE = Template("""
+    <p>{{parsed_bio or '(no info)' |safe}}</p>
+    <table>
+        {%- if gender %}
+        <tr>
+            <th>Gender</th>
+            <td>{{gender}}</td>
+        </tr>
+        {% endif -%}
+        {%- if birthday %}
+        <tr>
+            <th>Birthday</th>
+            <td>{{birthday}}</td>
+        </tr>
+        {% endif -%}
+        {%- if location %}
+        <tr>
+            <th>Location</th>
+            <td>{{location}}</td>
+        </tr>
+        {% endif -%}
+    </table>
+    """)
 
 
 def renderer(formats):
@@ -79,8 +175,7 @@ def text_plain(part, fmt, url):
     """
     if part.inline:
         if fmt == 'text/html':
-            return render_template_string(
-                '{{text|nl2br}}',
+            return _TEXT_AS_HTML.render(
                 text=part.mime_part.body.decode('utf-8')
             )
         if fmt == 'text/plain':
@@ -118,15 +213,7 @@ def common_images(part, fmt, url):
     Renderer for image/* that a browser can display in an <img> tag.
     """
     if fmt == 'text/html' and part.inline:
-        return render_template_string(
-            '<img src="{{url}}" alt="{{alt}}" />',
-            url=url_for(
-                'content.raw',
-                part_id=part.mime_part.id,
-                _external=True
-            ),
-            alt=part.mime_part.text_preview
-        )
+        return _IMAGE.render(url=url, alt=part.mime_part.text_preview)
 
 
 @renderer(['application/x-pyaspora-subscribe'])
@@ -138,13 +225,8 @@ def pyaspora_subscribe(part, fmt, url):
         return None
 
     payload = loads(part.mime_part.body.decode('utf-8'))
-    return render_template_string(
-        'subscribed to <a href="{{profile}}">{{name}}</a>',
-        profile=url_for(
-            'contacts.profile',
-            contact_id=payload['to'],
-            _external=True
-        ),
+    return _SUBSCRIBED.render(
+        profile=portable_url('contacts.profile', contact_id=payload['to']),
         name=payload.get('to_name', '(unknown)')
     )
 
@@ -159,13 +241,8 @@ def pyaspora_share(part, fmt, url):
 
     payload = loads(part.mime_part.body.decode('utf-8'))
     author = payload['author']
-    return render_template_string(
-        "shared <a href='{{profile}}'>{{name}}</a>'s post",
-        profile=url_for(
-            'contacts.profile',
-            contact_id=author['id'],
-            _external=True
-        ),
+    return _SHARED.render(
+        profile=portable_url('contacts.profile', contact_id=author['id']),
         name=author['name']
     )
 
@@ -182,8 +259,7 @@ def poll_question(part, fmt, url):
         return 'Question: {0}'.format(part.mime_part.body.decode('utf-8'))
 
     if fmt == 'text/html':
-        return render_template_string(
-            "Question: <strong>{{question}}</strong>",
+        return _POLL_QUESTION.render(
             question=part.mime_part.body.decode('utf-8')
         )
 
@@ -202,8 +278,7 @@ def poll_answer(part, fmt, url):
         return '- {0}'.format(part.mime_part.body.decode('utf-8'))
 
     if fmt == 'text/html':
-        return render_template_string(
-            "<ul style='margin: 0em'><li>{{question}}</li></ul>",
+        return _POLL_ANSWER.render(
             question=part.mime_part.body.decode('utf-8')
         )
 
@@ -224,22 +299,48 @@ def poll_participation(part, fmt, url):
         return 'answered the poll with {0}'.format(payload['answer_text'])
 
     if fmt == 'text/html':
-        return render_template_string(
-            "answered with <strong>{{answer}}</strong>",
+        return _POLL_PARTICIPATION.render(
             answer=payload['answer_text']
         )
 
     return None
 
 
-def render(part, fmt, url=None):
+def render(part, fmt):
     """
     Attempt to render the PostPart <part> into MIME format <fmt>, which is
     usually 'text/plain' or 'text/html'. There are fall-backs for these two
     formats - otherwise you may have to handle a null return.
     """
-    if not url:
-        url = url_for('content.raw', part_id=part.mime_part.id)
+    return localise_urls(render_portable(part, fmt))
+
+
+def render_portable(part, fmt):
+    """
+    As render(), but with links to this server left as placeholders (see
+    portable_url()), for output that is kept and shared between requests.
+
+    Renderings of 'text/plain' and 'text/html' are cached (see
+    pyaspora.content.cache), so must not depend on who is viewing the part,
+    nor on the host they reached it by; renderers must build links with
+    portable_url(). Renderings stored when the part was written can be loaded
+    into the cache in bulk with load_renderings().
+    """
+    if fmt not in FORMATS:
+        return _render(part, fmt)
+
+    key = (part.mime_part.id, fmt, bool(part.inline))
+    cached = render_cache.get(key)
+    if cached is not None:
+        return cached[0]
+
+    ret = _render(part, fmt)
+    render_cache.put(key, ret)
+    return ret
+
+
+def _render(part, fmt):
+    url = portable_url('content.raw', part_id=part.mime_part.id)
 
     ret = None
     renderer = renderer_exists(part.mime_part.type)
@@ -251,14 +352,12 @@ def render(part, fmt, url=None):
 
     defaults = {
         'text/html': {
-            True: lambda p: render_template_string(
-                '{{t}}', t=p.mime_part.text_preview),
-            False: lambda p: render_template_string(
-                '<a href="{{u}}">(link)</a>', u=url),
+            True: lambda p: _PREVIEW.render(t=p.mime_part.text_preview),
+            False: lambda p: _LINK_AS_HTML.render(u=url),
         },
         'text/plain': {
             True: lambda p: p.mime_part.text_preview,
-            False: lambda p: render_template_string('Link: {{u}}', u=url),
+            False: lambda p: _LINK_AS_TEXT.render(u=url),
         }
     }
 
@@ -275,32 +374,126 @@ def diaspora_profile(part, fmt, url):
     Renders a Diaspora profile received from a remote server. Diaspora has
     rather more feature-rich profiles than Pyaspora.
     """
-    payload = loads(part.mime_part.body.decode('utf-8'))
-    payload['parsed_bio'] = _markdown_to_html(payload.get('bio', None) or '')
     if fmt != 'text/html' or not part.inline:
         return None
 
-    templ = """
-    <p>{{parsed_bio or '(no info)' |safe}}</p>
-    <table>
-        {%- if gender %}
-        <tr>
-            <th>Gender</th>
-            <td>{{gender}}</td>
-        </tr>
-        {% endif -%}
-        {%- if birthday %}
-        <tr>
-            <th>Birthday</th>
-            <td>{{birthday}}</td>
-        </tr>
-        {% endif -%}
-        {%- if location %}
-        <tr>
-            <th>Location</th>
-            <td>{{location}}</td>
-        </tr>
-        {% endif -%}
-    </table>
+    payload = loads(part.mime_part.body.decode('utf-8'))
+    payload['parsed_bio'] = _markdown_to_html(payload.get('bio', None) or '')
+    return _PROFILE.render(**payload)
+
+
+def store_rendering(part):
+    """
+    Render the PostPart <part> into each cached format and store the results
+    as RenderedParts, so that they needn't be rendered when read. The caller
+    must commit the session.
+    """
+    for fmt in FORMATS:
+        key = (part.mime_part.id, fmt, bool(part.inline))
+        rendered = _render(part, fmt)
+        db.session.merge(RenderedPart(
+            mime_part_id=key[0],
+            format=fmt,
+            inline=key[2],
+            body=rendered
+        ))
+        render_cache.put(key, rendered)
+
+
+def render_on_commit(part):
+    """
+    If RENDER_ON_WRITE is enabled, arrange for the newly-added PostPart
+    <part> to be rendered and stored when the current transaction commits.
+    """
+    if current_app.config.get('RENDER_ON_WRITE', False):
+        db.session().info.setdefault('pending_renders', []).append(part)
+
+
+@event.listens_for(Session, 'before_commit')
+def _render_pending(session):
+    parts = session.info.pop('pending_renders', None)
+    if parts:
+        session.flush()  # Renderings are stored against the part IDs
+        for part in parts:
+            store_rendering(part)
+
+
+def load_bodies(parts, formats=FORMATS):
+    """
+    Load, in one query, the MimePart bodies that will be needed to render the
+    PostParts <parts> into MIME formats <formats>. Parts whose renderings are
+    already cached, and images (which are rendered as a link), are skipped.
+    """
+    needed = set()
+    for part in parts:
+        mime_type = part.mime_part.type
+        if not renderer_exists(mime_type) or \
+                mime_type in ACCEPTABLE_BROWSER_IMAGE_FORMATS:
+            continue
+        if any((part.mime_part_id, f, bool(part.inline)) not in render_cache
+               for f in formats):
+            needed.add(part.mime_part_id)
+    MimePart.load_bodies(needed)
+
+
+def load_renderings(parts):
+    """
+    Fill the render cache with the stored renderings of the PostParts
+    <parts>, in a single query, so that render() won't need to render them.
+    """
+    wanted = set(
+        p.mime_part_id for p in parts
+        if any((p.mime_part_id, f, bool(p.inline)) not in render_cache
+               for f in FORMATS)
+    )
+    if not wanted:
+        return
+    for rendered in RenderedPart.get_for_parts(wanted):
+        render_cache.prime(
+            (rendered.mime_part_id, rendered.format, rendered.inline),
+            rendered.body
+        )
+
+
+def render_markdown(parts):
+    """
+    Render all the inline Markdown PostParts in <parts> that are not already
+    in the render cache as HTML, in one batch.
+    """
+    todo = {}
+    for part in parts:
+        key = (part.mime_part_id, 'text/html', bool(part.inline))
+        if part.inline and part.mime_part.type == 'text/x-markdown' and \
+                key not in render_cache:
+            todo[key] = part.mime_part.body.decode('utf-8')
+    if todo:
+        keys = list(todo.keys())
+        rendered = markdown_to_html_many([todo[k] for k in keys])
+        for key, html in zip(keys, rendered):
+            render_cache.put(key, html)
+
+
+def rebuild_renderings(batch_size=100):
+    """
+    Discard all the stored renderings and render every part again, for
+    example after a renderer has been changed. Returns the number of parts
+    rendered.
     """
-    return render_template_string(templ, **payload)
+    from pyaspora.post.models import PostPart
+    db.session.query(RenderedPart).delete(synchronize_session=False)
+    db.session.commit()
+    render_cache.clear()
+
+    part_ids = sorted(r[0] for r in
+                      db.session.query(PostPart.mime_part_id).distinct())
+    done = set()
+    for start in range(0, len(part_ids), batch_size):
+        batch = part_ids[start:start + batch_size]
+        MimePart.load_bodies(batch)
+        for part in PostPart.get_parts_for_mime_parts(batch):
+            key = (part.mime_part_id, bool(part.inline))
+            if key not in done:
+                done.add(key)
+                store_rendering(part)
+        db.session.commit()
+    return len(done)
@@ -0,0 +1,211 @@
+"""
+Where MimePart bodies are kept. By default they are stored in the database,
+but if BLOB_FOLDER is configured then new bodies are written to files in
+that directory, named by the SHA-256 hash of their content. Identical content
+(for example, a reshared photo or an avatar downloaded again) is then only
+stored once.
+
+Existing bodies can be moved out of the database with:
+
+    ./quickstart.py move_bodies
+
+Files written during a database transaction that is then rolled back are
+removed again, unless a committed MimePart refers to the same content.
+"""
+from __future__ import absolute_import
+
+from flask import current_app, Request
+from io import BytesIO
+from hashlib import sha256
+from os import fdopen, makedirs, rename, unlink
+from os.path import basename, exists, isdir, join
+from shutil import move
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import select
+from tempfile import mkstemp, TemporaryFile
+
+from pyaspora.database import db
+
+# Bytes copied at a time when spooling an upload
+CHUNK_SIZE = 64 * 1024
+
+# Uploads larger than this are spooled to disk while the request is parsed
+IN_MEMORY_UPLOAD_SIZE = 500 * 1024
+
+
+class FileStore(object):
+    """
+    Stores blobs in a directory tree under <root>, sharded on the first two
+    pairs of hex digits of the hash so no one directory gets too large.
+    """
+    name = 'file'
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        """
+        The filename of the blob with hash <digest>.
+        """
+        return join(self.root, digest[0:2], digest[2:4], digest)
+
+    def save(self, digest, data):
+        """
+        Store <data>, which has hash <digest>, unless it is already stored.
+        """
+        path = self.path(digest)
+        if exists(path):
+            return
+        directory = join(self.root, digest[0:2], digest[2:4])
+        if not isdir(directory):
+            try:
+                makedirs(directory)
+            except OSError:  # Created by someone else in the meantime
+                pass
+        # Write then rename, so a reader never sees a partial file
+        fd, tmp_path = mkstemp(dir=directory)
+        try:
+            with fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            rename(tmp_path, path)
+        except:
+            unlink(tmp_path)
+            raise
+        _written(path)
+
+    def save_file(self, digest, path):
+        """
+        Store the file at <path>, which has hash <digest>, by moving it into
+        the store (or deleting it, if the content is already stored).
+        """
+        target = self.path(digest)
+        if exists(target):
+            unlink(path)
+            return
+        directory = join(self.root, digest[0:2], digest[2:4])
+        if not isdir(directory):
+            try:
+                makedirs(directory)
+            except OSError:  # Created by someone else in the meantime
+                pass
+        try:
+            rename(path, target)
+        except OSError:  # Probably on a different filesystem
+            move(path, target)
+        _written(target)
+
+    def open(self, digest):
+        """
+        Open the blob with hash <digest> for reading.
+        """
+        return open(self.path(digest), 'rb')
+
+    def load(self, digest):
+        """
+        Return the content of the blob with hash <digest>.
+        """
+        with self.open(digest) as blob:
+            return blob.read()
+
+
+def _written(path):
+    """
+    Note that the blob file <path> was created in the current transaction,
+    so that it can be removed if the transaction is rolled back.
+    """
+    db.session().info.setdefault('new_blobs', []).append(path)
+
+
+@event.listens_for(Session, 'after_commit')
+def _keep_written(session):
+    session.info.pop('new_blobs', None)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _remove_written(session):
+    paths = session.info.pop('new_blobs', None)
+    if not paths:
+        return
+    parts = db.metadata.tables['mime_parts']
+    with db.engine.connect() as conn:
+        for path in paths:
+            # Another transaction may have stored the same content
+            used = conn.execute(select([parts.c.id]).where(
+                parts.c.body_hash == basename(path)
+            ).limit(1)).first()
+            if not used and exists(path):
+                unlink(path)
+
+
+def blob_store(name=None):
+    """
+    The store named <name> (as recorded in MimePart.storage), or the store
+    that new bodies should be written to if <name> is None. Returns None for
+    the database.
+    """
+    folder = current_app.config.get('BLOB_FOLDER')
+    if name is None:
+        return FileStore(folder) if folder else None
+    if name == FileStore.name:
+        assert folder, 'BLOB_FOLDER must be configured to read stored parts'
+        return FileStore(folder)
+    raise ValueError('Unknown blob store {0}'.format(name))
+
+
+class UploadRequest(Request):
+    """
+    Request class which spools large uploaded files to UPLOAD_FOLDER while the
+    form is parsed, rather than the system temporary directory.
+    """
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if total_content_length is not None and \
+                total_content_length <= IN_MEMORY_UPLOAD_SIZE:
+            return BytesIO()
+        return TemporaryFile(
+            'wb+',
+            dir=current_app.config.get('UPLOAD_FOLDER')
+        )
+
+
+def spool_upload(stream):
+    """
+    Copy the file-like <stream> into a new temporary file in UPLOAD_FOLDER a
+    chunk at a time, hashing it as it goes. Returns the temporary file's path
+    and the hex SHA-256 hash of its content.
+    """
+    fd, path = mkstemp(dir=current_app.config.get('UPLOAD_FOLDER'))
+    digest = sha256()
+    try:
+        with fdopen(fd, 'wb') as spool:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                spool.write(chunk)
+    except:
+        unlink(path)
+        raise
+    return path, digest.hexdigest()
+
+
+def move_bodies(batch_size=100):
+    """
+    Move the bodies of all MimeParts that are kept in the database to the
+    configured blob store. Returns the number of parts moved.
+    """
+    from pyaspora.content.models import MimePart
+
+    assert blob_store(), 'BLOB_FOLDER must be configured to move parts'
+    part_ids = [r[0] for r in db.session.query(MimePart.id).
+                filter(MimePart.storage == None)]
+    for start in range(0, len(part_ids), batch_size):
+        batch = part_ids[start:start + batch_size]
+        MimePart.load_bodies(batch)
+        for part in db.session.query(MimePart).filter(MimePart.id.in_(batch)):
+            part.body = part.body  # re-store in the blob store
+        db.session.commit()
+        db.session.expunge_all()  # Let the bodies go
+    return len(part_ids)
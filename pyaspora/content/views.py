@@ -2,13 +2,29 @@ from __future__ import absolute_import
 
 from datetime import timedelta
 from flask import Blueprint
+from sqlalchemy import event
+from sqlalchemy.orm import object_session, Session
+from sqlalchemy.sql import select
 
 from pyaspora.content.models import MimePart
+from pyaspora.post.models import Post, PostPart, Share
 from pyaspora.user.session import logged_in_user
-from pyaspora.utils.rendering import abort, raw_response
+from pyaspora.utils.cache import LRUCache
+from pyaspora.utils.rendering import abort
 
 blueprint = Blueprint('content', __name__, template_folder='templates')
 
+# Parts a viewer has been allowed to see, keyed on (Contact ID, MimePart ID).
+# Only permission is remembered, so that a part shared with someone after
+# they were refused is visible straight away, and entries for a Post's parts
+# are dropped when its Shares change. Each process has its own cache, so a
+# part can stay visible for up to CONTENT_PERMISSION_TTL seconds after it is
+# hidden through another process.
+part_permissions = LRUCache(
+    'CONTENT_PERMISSION_CACHE_SIZE', 10000,
+    'CONTENT_PERMISSION_TTL', 300
+)
+
 
 @blueprint.route('/<int:part_id>/raw', methods=['GET'])
 def raw(part_id):
@@ -21,13 +37,37 @@ def raw(part_id):
         abort(404, 'No such content item', force_status=True)
 
     # If anyone has shared this part with us (or the public), we get to view
-    # it.
-    for link in part.posts:
-        if link.post.has_permission_to_view(logged_in):
-            return raw_response(
-                part.body,
-                part.type,
-                expiry_delta=timedelta(days=365)
-            )
+    # it. Pages show many parts, so remember the answer for a while.
+    contact = logged_in.contact if logged_in else None
+    key = (contact.id if contact else None, part.id)
+    if part_permissions.get(key) or Post.part_is_viewable(part.id, contact):
+        part_permissions.put(key, True)
+        return part.body_response(expiry_delta=timedelta(days=365))
 
     abort(403, 'Forbidden')
+
+
+@event.listens_for(Share, 'after_insert')
+@event.listens_for(Share, 'after_update')
+@event.listens_for(Share, 'after_delete')
+def _share_changed(mapper, connection, share):
+    # A new, hidden or removed Share can take away permission to see the
+    # Post's parts; forget them once the change is committed.
+    info = object_session(share).info
+    part_ids = info.setdefault('changed_part_permissions', set())
+    part_ids.update(r[0] for r in connection.execute(
+        select([PostPart.mime_part_id]).
+        where(PostPart.post_id == share.post_id)
+    ))
+
+
+@event.listens_for(Session, 'after_commit')
+def _forget_permissions(session):
+    part_ids = session.info.pop('changed_part_permissions', None)
+    if part_ids:
+        part_permissions.discard(lambda key: key[1] in part_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _keep_permissions(session):
+    session.info.pop('changed_part_permissions', None)
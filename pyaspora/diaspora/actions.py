@@ -12,16 +12,14 @@ from lxml import etree
 from re import compile as re_compile
 try:
     from urllib.parse import urljoin
-    from urllib.request import urlopen
 except:
-    from urllib2 import urlopen
     from urlparse import urljoin
 
 from pyaspora import db
 from pyaspora.content.models import MimePart
 from pyaspora.diaspora import import_url_as_mimepart
 from pyaspora.diaspora.models import DiasporaContact, DiasporaPart, \
-    DiasporaPost, TryLater
+    DiasporaPost, MessageQueue, PodHealth, TryLater
 from pyaspora.diaspora.protocol import DiasporaMessageBuilder
 from pyaspora.post.models import Post
 from pyaspora.roster.models import Subscription
@@ -78,32 +76,48 @@ class MessageHandlerBase:
     @classmethod
     def send(cls, u_from, c_to, **kwargs):
         """
-        Send a message from <u_from> to <c_to>.
+        Queue a message from <u_from> to <c_to> for delivery.
         """
         m = cls._build(u_from, c_to, **kwargs)
-        url = '{0}receive/users/{1}'.format(
-            c_to.diasp.server, c_to.diasp.guid)
-        current_app.logger.debug(u'posting {0} to {1}'.format(
+        current_app.logger.debug(u'queueing {0} for {1}'.format(
             etree.tostring(m.message),
-            url
+            c_to.id
         ))
-        resp = m.post(url, RSA.importKey(c_to.public_key))
-        return resp
+        return MessageQueue.queue_outgoing(
+            c_to,
+            m.create_salmon_envelope(RSA.importKey(c_to.public_key))
+        )
 
     @classmethod
     def send_public(cls, u_from, c_to, **kwargs):
         """
-        Send a message from <u_from> to the remote server that <c_to> is on,
+        Queue a message from <u_from> to the remote server that <c_to> is on,
         as a public message.
         """
+        return cls.send_public_many(u_from, [c_to], **kwargs)[0]
+
+    @classmethod
+    def send_public_many(cls, u_from, targets, **kwargs):
+        """
+        Queue a public message from <u_from> to each of the remote servers
+        that Contacts <targets> are on. A public envelope doesn't depend on
+        the recipient, so it is built and signed once and the same envelope
+        is sent to every server.
+        """
+        # De-dupe by server
+        targets = dict((c.diasp.server, c) for c in targets)
+        if not targets:
+            return []
         m = cls._build(u_from, None, **kwargs)
-        url = '{0}receive/public'.format(c_to.diasp.server)
-        current_app.logger.debug(u'posting {0} to {1}'.format(
+        envelope = m.create_salmon_envelope(None)
+        current_app.logger.debug(u'queueing {0} for {1}'.format(
             etree.tostring(m.message),
-            url
+            ', '.join(sorted(targets.keys()))
         ))
-        resp = m.post(url, None)
-        return resp
+        return [
+            MessageQueue.queue_outgoing(target, envelope, public=True)
+            for target in targets.values()
+        ]
 
     @classmethod
     def struct_to_xml(cls, node, struct):
@@ -603,10 +617,10 @@ class SubPost(SignableMixin, TagMixin, MessageHandlerBase):
         if is_public:
             targets += list(post.author.followers())
         targets = [c for c in targets if not c.user]
-        for target in targets:
-            if is_public:
-                cls.send_public(None, target, n=node, fn=_builder)
-            else:
+        if is_public:
+            cls.send_public_many(None, targets, n=node, fn=_builder)
+        else:
+            for target in targets:
                 cls.send(u_from, target, n=node, fn=_builder)
 
 
@@ -754,7 +768,7 @@ class Photo(MessageHandlerBase):
         photo_url = urljoin(
             data['remote_photo_path'], data['remote_photo_name']
         )
-        resp = urlopen(photo_url, timeout=10)
+        resp = PodHealth.fetch(photo_url)
         mime = resp.info().get('Content-Type')
         part = MimePart(
             type=mime,
@@ -796,7 +810,7 @@ class Reshare(MessageHandlerBase):
             post_url = urljoin(author.server, "/p/{0}.xml".format(
                 data['root_guid']
             ))
-            resp = urlopen(post_url, timeout=10)
+            resp = PodHealth.fetch(post_url)
             current_app.logger.debug(
                 'Injecting downloaded message into processing loop'
             )
@@ -960,7 +974,12 @@ class AccountDeletion(MessageHandlerBase):
             type="text/plain"
         )
         db.session.add(participant)
+        followers = [
+            c for c in participant.contact.followers() if c.user
+        ]
         db.session.query(Subscription).filter(
             Subscription.to_contact == participant.contact
         ).delete()
+        for follower in followers:
+            follower.rebuild_feed()
         db.session.commit()
@@ -0,0 +1,224 @@
+"""
+Delivery of queued outgoing messages to remote nodes. Messages are queued by
+MessageHandlerBase.send() and send_public() as part of the web request that
+caused them, and are sent by the "deliver_queue" maintenance command.
+
+Deliveries are made concurrently by the asyncio engine in
+pyaspora.diaspora.engine, at most DELIVERY_WORKERS at once in total and
+DELIVERY_PER_HOST at once to any one server, so that one slow or unreachable
+server doesn't hold up delivery to the others. On Pythons without it, a
+plain pool of DELIVERY_WORKERS threads is used instead.
+
+Messages for servers whose circuit is open (see PodHealth) are left in the
+queue until it closes, and the outcome of each batch is recorded against
+each server's PodHealth.
+"""
+from __future__ import absolute_import
+
+from collections import defaultdict, namedtuple
+from datetime import datetime
+from flask import current_app
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import and_
+from threading import Thread
+from time import time
+from traceback import format_exc
+try:
+    from queue import Queue
+    from urllib.error import HTTPError
+    from urllib.parse import urlsplit
+except:
+    from Queue import Queue
+    from urllib2 import HTTPError
+    from urlparse import urlsplit
+
+from pyaspora.contact.models import Contact
+from pyaspora.database import db
+from pyaspora.diaspora.models import MessageQueue, PodHealth
+from pyaspora.diaspora.protocol import DiasporaMessageBuilder
+
+
+class DeliveryResult(namedtuple('DeliveryResult', [
+    'target', 'url', 'status', 'error', 'elapsed'
+])):
+    """
+    The outcome of delivering an envelope to <target> (whatever the caller
+    used to identify it) at <url>. <status> is the HTTP status, if the
+    server responded; <error> is None if the envelope was delivered, or a
+    description of the failure; <elapsed> is in seconds, or None if the
+    delivery wasn't attempted.
+    """
+    @property
+    def sent(self):
+        return self.error is None
+
+
+def send_envelope(app, target, url, envelope, timeout=None, down=None):
+    """
+    Deliver <envelope> to <url> within an application context for <app>,
+    and return the DeliveryResult. If <down> is a set of host names, the
+    delivery is skipped if the host is in it, and the host is added to it if
+    it doesn't respond, so that one batch doesn't wait for the same dead
+    server over and over.
+    """
+    host = urlsplit(url).netloc
+    if down is not None and host in down:
+        return DeliveryResult(
+            target, url, None, '{0} is not responding'.format(host), None
+        )
+    start = time()
+    status = error = None
+    with app.app_context():
+        try:
+            status = DiasporaMessageBuilder.post_envelope(
+                url, envelope, timeout=timeout
+            ).status
+        except Exception as e:
+            if isinstance(e, HTTPError):
+                status = e.code
+            error = format_exc()
+            current_app.logger.warning(
+                u'Delivery to {0} failed\n{1}'.format(url, error)
+            )
+            if down is not None and status is None:
+                down.add(host)
+    return DeliveryResult(target, url, status, error, time() - start)
+
+
+def _deliver_all_threaded(app, deliveries, concurrency, timeout):
+    """
+    Fallback for deliver_all() that uses a pool of <concurrency> threads,
+    without any per-host limit.
+    """
+    queue = Queue()
+    results = []
+    down = set()
+
+    def _worker():
+        while True:
+            delivery = queue.get()
+            if delivery is None:
+                return
+            results.append(send_envelope(app, *delivery, timeout=timeout,
+                                         down=down))
+
+    threads = [Thread(target=_worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for delivery in deliveries:
+        queue.put(delivery)
+    for thread in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def deliver_all(deliveries, concurrency=None, per_host=None, timeout=None):
+    """
+    Deliver each of <deliveries>, a list of (target, url, envelope), with
+    at most <concurrency> deliveries in progress at once, and at most
+    <per_host> to any one host. Returns a DeliveryResult for each, in no
+    particular order.
+    """
+    if concurrency is None:
+        concurrency = current_app.config.get('DELIVERY_WORKERS', 20)
+    if per_host is None:
+        per_host = current_app.config.get('DELIVERY_PER_HOST', 2)
+    concurrency = max(int(concurrency), 1)
+    per_host = max(int(per_host), 1)
+    if not deliveries:
+        return []
+
+    app = current_app._get_current_object()
+    try:
+        from pyaspora.diaspora.engine import deliver_concurrently
+    except (ImportError, SyntaxError):  # No asyncio
+        return _deliver_all_threaded(app, deliveries, concurrency, timeout)
+    return deliver_concurrently(app, deliveries, concurrency, per_host,
+                                timeout)
+
+
+def claim_pending(limit):
+    """
+    Mark up to <limit> outgoing messages that are due to be sent as being
+    attempted now, so that other workers will leave them alone, and return
+    their IDs.
+    """
+    candidates = db.session.query(MessageQueue.id).filter(
+        MessageQueue.Queries.pending_outgoing_items()
+    ).order_by(MessageQueue.created_at).limit(limit)
+    now = datetime.now()
+    claimed = []
+    for (queue_id,) in candidates.all():
+        # Only claim it if nobody else has since we looked
+        updated = db.session.query(MessageQueue).filter(and_(
+            MessageQueue.id == queue_id,
+            MessageQueue.Queries.pending_outgoing_items()
+        )).update({'last_attempted_at': now}, synchronize_session=False)
+        if updated:
+            claimed.append(queue_id)
+    db.session.commit()
+    return claimed
+
+
+def _record_health(health, results):
+    """
+    Record the outcome of one batch of deliveries to a server against its
+    PodHealth <health>: a success if any delivery succeeded, otherwise a
+    failure.
+    """
+    attempted = [r for r in results if r.elapsed is not None]
+    if not attempted:
+        return
+    elapsed = sum(r.elapsed for r in attempted) / len(attempted)
+    if [r for r in attempted if r.sent]:
+        health.record(None, elapsed)
+    else:
+        health.record(attempted[-1].error.strip().splitlines()[-1], elapsed)
+
+
+def deliver_pending(concurrency=None, per_host=None, batch_size=None):
+    """
+    Send every outgoing message that is currently due, and record the
+    results in the queue. Returns the number of messages sent, the number
+    that failed and the number deferred because their server's circuit is
+    open.
+    """
+    if batch_size is None:
+        batch_size = 500
+    sent = failed = deferred = 0
+    while True:
+        claimed = claim_pending(batch_size)
+        if not claimed:
+            break
+        items = dict((i.id, i) for i in db.session.query(MessageQueue).
+                     filter(MessageQueue.id.in_(claimed)).
+                     options(joinedload(MessageQueue.remote, Contact.diasp)))
+        servers = dict((i.id, i.remote.diasp.server) for i in items.values())
+        health = PodHealth.get_many(servers.values())
+        now = datetime.now()
+        to_send = []
+        for item in items.values():
+            if health[servers[item.id]].is_open(now):
+                # Leave it claimed, to be looked at again later
+                deferred += 1
+                if item.too_old_for_retry:
+                    db.session.delete(item)
+            else:
+                to_send.append((item.id, item.target_url(), item.body))
+
+        results = deliver_all(to_send, concurrency, per_host)
+        by_server = defaultdict(list)
+        for result in results:
+            items[result.target].record_delivery(result.error)
+            by_server[servers[result.target]].append(result)
+            if result.sent:
+                sent += 1
+            else:
+                failed += 1
+        for server, server_results in by_server.items():
+            _record_health(health[server], server_results)
+        db.session.commit()
+    return sent, failed, deferred
@@ -0,0 +1,65 @@
+"""
+An asyncio engine for delivering envelopes to many remote servers at once.
+Each delivery is made with the shared keep-alive HTTP client in a worker
+thread, scheduled so that no more than a global limit are in progress at
+once, and no more than a per-host limit to any one server.
+
+This needs Python 3.7 or above; pyaspora.diaspora.delivery falls back to a
+thread pool on older versions.
+"""
+from __future__ import absolute_import
+
+from asyncio import gather, get_running_loop, run, Semaphore
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from pyaspora.diaspora.delivery import send_envelope
+
+
+async def _deliver(loop, executor, limit, host_limit, down, app, delivery,
+                   timeout):
+    # Wait for the host first, so that deliveries queued behind a busy
+    # server don't hold global slots that other servers could use.
+    async with host_limit:
+        async with limit:
+            return await loop.run_in_executor(
+                executor,
+                lambda: send_envelope(app, *delivery, timeout=timeout,
+                                      down=down)
+            )
+
+
+async def _deliver_all(executor, app, deliveries, concurrency, per_host,
+                       timeout):
+    loop = get_running_loop()
+    limit = Semaphore(concurrency)
+    host_limits = defaultdict(lambda: Semaphore(per_host))
+    down = set()
+    return await gather(*[
+        _deliver(
+            loop,
+            executor,
+            limit,
+            host_limits[urlsplit(delivery[1]).netloc],
+            down,
+            app,
+            delivery,
+            timeout
+        )
+        for delivery in deliveries
+    ])
+
+
+def deliver_concurrently(app, deliveries, concurrency, per_host,
+                         timeout=None):
+    """
+    Deliver each of <deliveries>, a list of (target, url, envelope), with
+    at most <concurrency> deliveries in progress at once and at most
+    <per_host> to any one host. Returns a list of DeliveryResults in the
+    same order as <deliveries>.
+    """
+    with ThreadPoolExecutor(concurrency) as executor:
+        return run(_deliver_all(
+            executor, app, deliveries, concurrency, per_host, timeout
+        ))
@@ -5,29 +5,31 @@ from datetime import datetime, timedelta
 from flask import current_app, request, url_for
 from json import load as json_load
 from lxml import html
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, LargeBinary, \
-    String
-from sqlalchemy.orm import backref, relationship
+from sqlalchemy import Column, DateTime, Float, ForeignKey, Integer, \
+    LargeBinary, String, Text, event
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import backref, relationship, Session
 from sqlalchemy.sql import and_, or_
 from sqlalchemy.sql.expression import func
+from time import time
 from traceback import format_exc
 from uuid import uuid4
 try:
     from urllib.error import URLError
     from urllib.parse import urljoin, urlsplit, urlunsplit
-    from urllib.request import Request, urlopen
 except:
-    from urllib2 import Request, URLError, urlopen
+    from urllib2 import URLError
     from urlparse import urljoin, urlsplit, urlunsplit
 
 from pyaspora import db
 from pyaspora.contact.models import Contact
 from pyaspora.content.models import MimePart
 from pyaspora.diaspora import import_url_as_mimepart
-from pyaspora.diaspora.protocol import DiasporaMessageParser, USER_AGENT, \
+from pyaspora.diaspora.protocol import DiasporaMessageParser, \
     WebfingerRequest
 from pyaspora.post.models import Post
 from pyaspora.post.views import json_post
+from pyaspora.utils.http_client import http_client
 
 
 class TryLater(Exception):
@@ -110,9 +112,7 @@ class DiasporaContact(db.Model):
             '//XRD:Link[@rel="http://microformats.org/profile/hcard"]/@href',
             namespaces=NS
         )[0]
-        req = Request(hcard_url)
-        req.add_header('User-Agent', USER_AGENT)
-        hcard = html.parse(urlopen(req, timeout=10))
+        hcard = html.parse(PodHealth.fetch(hcard_url))
         c.realname = hcard.xpath('//*[@class="fn"]')[0].text
 
         pod_loc = hcard.xpath('//*[@id="pod_location"]')[0].text
@@ -181,10 +181,10 @@ class DiasporaContact(db.Model):
         from them.
         """
         url = self.server + 'people/{0}'.format(self.guid)
-        req = Request(url)
-        req.add_header('User-Agent', USER_AGENT)
-        req.add_header('Accept', 'application/json')
-        entries = json_load(urlopen(req, timeout=10))
+        entries = json_load(PodHealth.fetch(
+            url,
+            headers={'Accept': 'application/json'}
+        ))
         if isinstance(entries, dict):
             return  # Faulty node?
         for entry in entries:
@@ -236,7 +236,9 @@ class DiasporaContact(db.Model):
 class MessageQueue(db.Model):
     """
     Messages that have been received but that cannot be actioned until the
-    User's public key has been unlocked (at which point they will be deleted).
+    User's public key has been unlocked (at which point they will be deleted),
+    and messages waiting to be sent to remote nodes by the delivery workers
+    (see pyaspora.diaspora.delivery).
 
     Fields:
         id - an integer identifier uniquely identifying the message in the
@@ -248,6 +250,8 @@ class MessageQueue(db.Model):
     """
     INCOMING = 'application/x-diaspora-slap'
     PUBLIC_INCOMING = 'application/x-diaspora-public-slap'
+    OUTGOING = 'application/x-diaspora-outgoing-slap'
+    PUBLIC_OUTGOING = 'application/x-diaspora-outgoing-public-slap'
 
     __tablename__ = 'message_queue'
     id = Column(Integer, primary_key=True)
@@ -262,6 +266,7 @@ class MessageQueue(db.Model):
     error = Column(LargeBinary, nullable=True)
 
     local_user = relationship('User', backref='message_queue')
+    remote = relationship('Contact')
 
     class Queries:
         @classmethod
@@ -287,6 +292,20 @@ class MessageQueue(db.Model):
                 )
             )
 
+        @classmethod
+        def pending_outgoing_items(cls):
+            return and_(
+                MessageQueue.format.in_([
+                    MessageQueue.OUTGOING,
+                    MessageQueue.PUBLIC_OUTGOING
+                ]),
+                or_(
+                    MessageQueue.last_attempted_at == None,
+                    MessageQueue.last_attempted_at <=
+                    datetime.now() - timedelta(minutes=5)
+                )
+            )
+
     @classmethod
     def has_pending_items(cls, user):
         first = db.session.query(cls).filter(
@@ -349,6 +368,45 @@ class MessageQueue(db.Model):
         )
         process_incoming_message(ret, c_from, user)
 
+    @classmethod
+    def queue_outgoing(cls, contact, envelope, public=False):
+        """
+        Queue the Salmon envelope <envelope> for delivery to remote Contact
+        <contact> (or to the public endpoint of <contact>'s server if
+        <public>). It will be sent once the session has been committed.
+        """
+        queue_item = cls(
+            local_user=None,
+            remote=contact,
+            format=cls.PUBLIC_OUTGOING if public else cls.OUTGOING,
+            body=envelope
+        )
+        db.session.add(queue_item)
+        return queue_item
+
+    def target_url(self):
+        """
+        The URL to deliver this outgoing message to.
+        """
+        diasp = self.remote.diasp
+        if self.format == self.PUBLIC_OUTGOING:
+            return '{0}receive/public'.format(diasp.server)
+        return '{0}receive/users/{1}'.format(diasp.server, diasp.guid)
+
+    def record_delivery(self, error=None):
+        """
+        Record the outcome of trying to send this outgoing message. It is
+        removed from the queue if it was sent (<error> is None), or if it has
+        failed for too long; otherwise <error> is kept and it will be retried
+        later.
+        """
+        if error is None or self.too_old_for_retry:
+            db.session.delete(self)
+        else:
+            self.last_attempted_at = datetime.now()
+            self.error = error.encode('utf-8')
+            db.session.add(self)
+
     @property
     def too_old_for_retry(self):
         if not self.last_attempted_at:
@@ -357,6 +415,178 @@ class MessageQueue(db.Model):
         return self.last_attempted_at > self.created_at + timedelta(hours=24)
 
 
+class PodHealth(db.Model):
+    """
+    How a remote server has been responding recently, keyed on the server's
+    base URL (as in DiasporaContact.server). After POD_FAILURE_THRESHOLD
+    failures in a row the server's circuit is opened: nothing is sent to or
+    fetched from it until next_attempt_at, which backs off exponentially from
+    POD_BACKOFF seconds (up to POD_BACKOFF_MAX) with each further failure. A
+    success closes the circuit again.
+
+    Fields:
+        server - the base URL of the server, eg. "https://pod.example.com/"
+        failures - how many times in a row the server has failed
+        latency - a moving average of the server's response time, in seconds
+        last_success_at - when the server last responded successfully
+        last_failure_at - when the server last failed
+        last_error - a description of the last failure
+        next_attempt_at - if the circuit is open, when it will close
+    """
+    __tablename__ = 'pod_health'
+    server = Column(String, primary_key=True)
+    failures = Column(Integer, nullable=False, default=0)
+    latency = Column(Float, nullable=True)
+    last_success_at = Column(DateTime(timezone=True), nullable=True)
+    last_failure_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(Text, nullable=True)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=True)
+
+    @classmethod
+    def server_for_url(cls, url):
+        """
+        The base URL of the server that <url> is on.
+        """
+        parts = urlsplit(url)
+        return urlunsplit((parts.scheme, parts.netloc, '/', '', ''))
+
+    @classmethod
+    def get_many(cls, servers):
+        """
+        A dict of the PodHealth for each of <servers>, creating (but not
+        committing) records for servers that haven't been seen before.
+        """
+        servers = set(servers)
+        health = dict((h.server, h) for h in db.session.query(cls).filter(
+            cls.server.in_(servers)
+        )) if servers else {}
+        for server in servers - set(health.keys()):
+            health[server] = cls(server=server, failures=0)
+            db.session.add(health[server])
+        return health
+
+    @classmethod
+    def fetch(cls, url, **kwargs):
+        """
+        Fetch <url> with the shared HTTP client (passing it <kwargs>) unless
+        the server's circuit is open, in which case URLError is raised
+        straight away. The outcome is committed in a separate transaction
+        when the caller's ends, as the caller's is usually rolled back if
+        the fetch fails, and may hold locks (on SQLite, on the whole
+        database) that a concurrent transaction would wait for.
+        """
+        server = cls.server_for_url(url)
+        health = db.session.query(cls).get(server)
+        if health and health.is_open():
+            raise URLError('{0} is not being contacted until {1}'.format(
+                server, health.next_attempt_at
+            ))
+        start = time()
+        try:
+            resp = http_client.get(url, **kwargs)
+        except URLError as e:
+            # Only count it against the server if it didn't answer properly
+            if getattr(e, 'code', None) is None or e.code >= 500:
+                cls._record_later(server, str(e), time() - start)
+            raise
+        cls._record_later(server, None, time() - start)
+        return resp
+
+    @classmethod
+    def _record_later(cls, server, error, elapsed):
+        """
+        Arrange for the outcome of contacting <server> (see record()) to be
+        recorded when the current transaction ends.
+        """
+        db.session().info.setdefault('pod_health', []).append(
+            (server, error, elapsed)
+        )
+
+    @classmethod
+    def _record_now(cls, outcomes):
+        """
+        Record the outcomes of contacting servers, a list of (server, error,
+        elapsed) (see record()), and commit them in a session of their own.
+        """
+        session = Session(bind=db.engine)
+        try:
+            for server, error, elapsed in outcomes:
+                health = session.query(cls).get(server)
+                if not health:
+                    health = cls(server=server, failures=0)
+                    session.add(health)
+                health.record(error, elapsed)
+            session.commit()
+        except SQLAlchemyError:
+            # Losing the outcomes is better than failing the caller
+            session.rollback()
+            current_app.logger.warning(
+                u'Could not record health of {0}\n{1}'.format(
+                    ', '.join(o[0] for o in outcomes), format_exc()
+                )
+            )
+        finally:
+            session.close()
+
+    def is_open(self, now=None):
+        """
+        Whether this server's circuit is open, so that it shouldn't be
+        contacted.
+        """
+        return bool(self.next_attempt_at and
+                    self.next_attempt_at > (now or datetime.now()))
+
+    def record(self, error=None, elapsed=None):
+        """
+        Record the outcome of contacting this server: <error> is None if it
+        succeeded, and <elapsed> is how long it took, in seconds. The caller
+        must add the record to a session and commit it.
+        """
+        now = datetime.now()
+        if elapsed is not None:
+            self.latency = elapsed if self.latency is None \
+                else 0.8 * self.latency + 0.2 * elapsed
+        if error is None:
+            self.failures = 0
+            self.last_success_at = now
+            self.next_attempt_at = None
+        else:
+            self.failures = (self.failures or 0) + 1
+            self.last_failure_at = now
+            self.last_error = error
+            threshold = current_app.config.get('POD_FAILURE_THRESHOLD', 3)
+            if self.failures >= threshold:
+                backoff = min(
+                    current_app.config.get('POD_BACKOFF', 60) *
+                    2 ** (self.failures - threshold),
+                    current_app.config.get('POD_BACKOFF_MAX', 86400)
+                )
+                self.next_attempt_at = now + timedelta(seconds=backoff)
+
+    def as_dict(self):
+        def _dt(when):
+            return when.isoformat() if when else None
+        return {
+            'server': self.server,
+            'open': self.is_open(),
+            'failures': self.failures,
+            'latency': self.latency,
+            'last_success_at': _dt(self.last_success_at),
+            'last_failure_at': _dt(self.last_failure_at),
+            'last_error': self.last_error,
+            'next_attempt_at': _dt(self.next_attempt_at),
+        }
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _record_pending_health(session, transaction):
+    if transaction.parent is not None:
+        return
+    outcomes = session.info.pop('pod_health', None)
+    if outcomes:
+        PodHealth._record_now(outcomes)
+
+
 class DiasporaPost(db.Model):
     __tablename__ = 'diaspora_posts'
     post_id = Column(Integer, ForeignKey('posts.id'), primary_key=True)
@@ -385,7 +615,7 @@ class DiasporaPost(db.Model):
         return db.session.query(cls).filter(cls.guid == guid).first()
 
     def as_text(self):
-        json = json_post(self.post, children=False)
+        json = json_post(self.post, children=False, formats=('text',))
         text = "\n\n".join([p['body']['text'] for p in json['parts']])
         if self.post.tags:
             text += '\n( ' + ' '.join(
@@ -440,15 +670,12 @@ class DiasporaPost(db.Model):
         sender = senders['private' if private else 'public']
         sender = sender['child' if post.parent else 'parent']
         if public:
-            # De-dupe by server
-            targets = dict((c.diasp.server, c) for c in targets)
-            for target in targets.values():
-                sender.send_public(
-                    post.author.user,
-                    target,
-                    post=post,
-                    text=text
-                )
+            sender.send_public_many(
+                post.author.user,
+                targets,
+                post=post,
+                text=text
+            )
         else:
             # Can only send to followers
             followers = set([c.id for c in post.author.followers()])
@@ -465,15 +692,12 @@ class DiasporaPost(db.Model):
         message.
         """
         from pyaspora.diaspora.actions import Reshare
-        # De-dupe by server
-        targets = dict((c.diasp.server, c) for c in targets)
-        for target in targets.values():
-            Reshare.send_public(
-                self.post.author.user,
-                target,
-                post=self.post,
-                reshare=reshared_post
-            )
+        Reshare.send_public_many(
+            self.post.author.user,
+            targets,
+            post=self.post,
+            reshare=reshared_post
+        )
 
     def can_reply_with(self, target):
         if target.name == 'self':
@@ -14,23 +14,18 @@ from sys import version as python_version
 try:
     from urllib.parse import quote as url_quote, quote_plus, unquote_plus, \
         urlencode, urlparse
-    from urllib.request import build_opener, HTTPRedirectHandler, Request, \
-        urlopen
 except:
     from urllib import quote as url_quote, quote_plus, unquote_plus, \
         urlencode
-    from urllib2 import build_opener, HTTPRedirectHandler, Request, urlopen
     from urlparse import urlparse
 
+from pyaspora.utils.http_client import http_client
+
 
 # The namespace for the Diaspora envelope
 PROTOCOL_NS = "https://joindiaspora.com/protocol"
 
 
-# Our user agent
-USER_AGENT = 'Pyaspora/0.x'
-
-
 class DiasporaMessageBuilder:
     """
     A class to take a payload message and wrap it in the outer Diaspora
@@ -232,14 +227,20 @@ class DiasporaMessageBuilder:
         """
         Actually send the message to an HTTP/HTTPs endpoint.
         """
-        xml = url_quote(
-            self.create_salmon_envelope(recipient_public_key))
+        return self.post_envelope(
+            url, self.create_salmon_envelope(recipient_public_key))
+
+    @classmethod
+    def post_envelope(cls, url, envelope, timeout=None):
+        """
+        Send an envelope previously built by create_salmon_envelope() to an
+        HTTP/HTTPs endpoint.
+        """
+        xml = url_quote(envelope)
         data = urlencode({
             'xml': xml
         })
-        req = Request(url)
-        req.add_header('User-Agent', USER_AGENT)
-        return urlopen(req, data.encode("ascii"), timeout=60)
+        return http_client.post(url, data.encode("ascii"), timeout=timeout)
 
 
 class DiasporaMessageParser:
@@ -388,9 +389,8 @@ class WebfingerRequest(object):
             ),
             template_url
         )
-        req = Request(target_url)
-        req.add_header('User-Agent', USER_AGENT)
-        return etree.parse(urlopen(req))
+        from pyaspora.diaspora.models import PodHealth
+        return etree.parse(PodHealth.fetch(target_url))
 
     def _get_template(self):
         """
@@ -439,10 +439,8 @@ class HostMeta(object):
         """
         Create the connection to the remote host.
         """
-        request = Request(url)
-        opener = build_opener(RedirectTrackingHandler())
-        opener.addheaders = [('User-Agent', USER_AGENT)]
-        return opener.open(request, timeout=5)
+        from pyaspora.diaspora.models import PodHealth
+        return PodHealth.fetch(url, timeout=5)
 
     def _get_connection(self):
         """
@@ -455,9 +453,9 @@ class HostMeta(object):
             self.secure = False
             res = self._open_url(self._build_url("http"))
 
-        if self.secure and hasattr(res, "redirected_via"):
+        if self.secure:
             # Check redirections
-            for u in res.redirected_via:
+            for u in res.redirected_via + [res.geturl()]:
                 up = urlparse(u)
                 if up.scheme != "https":
                     self.secure = False
@@ -484,23 +482,3 @@ class HostMeta(object):
         assert current_app.config.get('ALLOW_INSECURE_COMPAT', False), \
             "Configuration doesn't permit HTTP lookup"
 
-
-class RedirectTrackingHandler(HTTPRedirectHandler):
-    """
-    Utility class that spots if we are redirected via a non-HTTPS site.
-    """
-    def http_error_301(self, req, fp, code, msg, headers):
-        new_url = req.get_full_url()
-        result = HTTPRedirectHandler.http_error_301(
-            self, req, fp, code, msg, headers)
-        if not hasattr(result, "redirected_via"):
-            result.redirected_via = []
-        result.redirected_via.append(new_url)
-
-    def http_error_302(self, req, fp, code, msg, headers):
-        previous_url = req.url
-        result = HTTPRedirectHandler.http_error_302(
-            self, req, fp, code, msg, headers)
-        if not hasattr(result, "redirected_via"):
-            result.redirected_via = []
-        result.redirected_via.append(previous_url)
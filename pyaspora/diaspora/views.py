@@ -24,11 +24,12 @@ from pyaspora import db
 from pyaspora.contact.models import Contact
 from pyaspora.diaspora.actions import process_incoming_message
 from pyaspora.diaspora.models import DiasporaContact, DiasporaPost, \
-    MessageQueue, TryLater
+    MessageQueue, PodHealth, TryLater
 from pyaspora.diaspora.protocol import DiasporaMessageParser
 from pyaspora.post.models import Post, Share
 from pyaspora.user.models import User
-from pyaspora.user.session import require_logged_in_user
+from pyaspora.user.session import require_admin_user, \
+    require_logged_in_user
 from pyaspora.utils.rendering import add_logged_in_user_to_data, \
     redirect, render_response, send_xml
 
@@ -336,6 +337,18 @@ def run_public_queue(_user):
     return redirect(url_for('feed.view'))
 
 
+@blueprint.route('/diaspora/pods', methods=['GET'])
+@require_admin_user
+def pod_health(_user):
+    """
+    JSON list of how each remote server has been responding, and whether
+    we've stopped contacting it for now. Only available to the site
+    administrators listed in the ADMINS setting.
+    """
+    pods = db.session.query(PodHealth).order_by(PodHealth.server)
+    return jsonify({'pods': [p.as_dict() for p in pods]})
+
+
 @blueprint.route('/statistics.json', methods=['GET'])
 def stats():
     return jsonify({
@@ -0,0 +1,163 @@
+"""
+An in-process cache of rendered feed pages, so that reloading the feed
+doesn't re-serialise the same posts when nothing has changed.
+
+Pages are cached per local Contact and per cursor. Anything that changes
+which posts are in a feed, or how they display, invalidates the Contact's
+pages (see FeedItem) once the transaction making the change commits. A page
+being built while the change commits is not cached, as it may predate it.
+
+Each worker process has its own cache, and a change only invalidates the
+cache of the process that made it. Entries expire after FEED_CACHE_TTL
+seconds, which bounds how stale a page can be if the change happened in a
+different process (for example, a user may not see their own new post for
+that long if their next request goes to another process). Deployments with
+several worker processes should keep FEED_CACHE_TTL short, or set
+FEED_CACHE_SIZE to 0 to turn the cache off.
+"""
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from threading import Lock
+from time import time
+
+from pyaspora.database import db
+
+DEFAULT_SIZE = 1000
+DEFAULT_TTL = 60
+PAGES_PER_CONTACT = 10
+
+
+class FeedCache(object):
+    """
+    LRU cache of feed pages. The least-recently-used Contact's pages are
+    discarded when more than FEED_CACHE_SIZE Contacts have cached pages.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+    def _config(self, name, default):
+        try:
+            return current_app.config.get(name, default)
+        except RuntimeError:  # No application context
+            return default
+
+    def get(self, contact_id, page_key):
+        """
+        Return the cached page <page_key> for Contact ID <contact_id>, or None
+        if there isn't a current one.
+        """
+        now = time()
+        with self.lock:
+            pages = self.entries.get(contact_id)
+            entry = pages.get(page_key) if pages else None
+            if entry and entry[0] > now:
+                self.counters['hits'] += 1
+                self.entries.pop(contact_id)
+                self.entries[contact_id] = pages  # most recently used
+                return entry[1]
+            if entry:
+                del pages[page_key]
+            self.counters['misses'] += 1
+            return None
+
+    def generation(self, contact_id):
+        """
+        A token to take before building a page for Contact ID <contact_id>
+        and pass to put(), so that the page isn't cached if the Contact's
+        feed changed while it was being built.
+        """
+        with self.lock:
+            return self.generations.get(contact_id, 0)
+
+    def put(self, contact_id, page_key, data, generation=None):
+        """
+        Store page <page_key> for Contact ID <contact_id>, unless the feed
+        has been invalidated since generation() returned <generation>.
+        """
+        size = self._config('FEED_CACHE_SIZE', DEFAULT_SIZE)
+        if not size:
+            return
+        expires = time() + self._config('FEED_CACHE_TTL', DEFAULT_TTL)
+        with self.lock:
+            if generation is not None and \
+                    generation != self.generations.get(contact_id, 0):
+                return
+            pages = self.entries.pop(contact_id, None) or OrderedDict()
+            pages[page_key] = (expires, data)
+            while len(pages) > PAGES_PER_CONTACT:
+                pages.popitem(last=False)
+            self.entries[contact_id] = pages
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def invalidate(self, contact_ids):
+        """
+        Discard all cached pages for the Contacts with IDs <contact_ids>.
+        """
+        with self.lock:
+            for contact_id in contact_ids:
+                self.generations[contact_id] = \
+                    self.generations.get(contact_id, 0) + 1
+                if self.entries.pop(contact_id, None) is not None:
+                    self.counters['invalidations'] += 1
+
+    def invalidate_on_commit(self, contact_ids):
+        """
+        Discard all cached pages for the Contacts with IDs <contact_ids> when
+        the current transaction commits, so that a page built from the old
+        data in the meantime can't be cached after the change.
+        """
+        db.session().info.setdefault('feed_invalidations', set()). \
+            update(contact_ids)
+
+    def clear(self):
+        """
+        Discard everything in the cache.
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def is_empty(self):
+        return not self.entries
+
+    def stats(self):
+        """
+        Counters and sizes suitable for serialisation.
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats['contacts'] = len(self.entries)
+            stats['pages'] = sum(len(p) for p in self.entries.values())
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = float(stats['hits']) / lookups if lookups \
+            else None
+        return stats
+
+
+feed_cache = FeedCache()
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_pending(session):
+    contact_ids = session.info.pop('feed_invalidations', None)
+    if contact_ids:
+        feed_cache.invalidate(contact_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop('feed_invalidations', None)
@@ -0,0 +1,92 @@
+"""
+Notification of feed changes to connected clients, for the Server-Sent Events
+stream in the feed views.
+
+When a thread is added to or bumped in a user's feed (see FeedItem), the
+thread ID is published to any open streams for that user once the database
+transaction commits. The broker lives in-process, so a stream only hears
+about changes made by the same server process; clients should catch up with
+the feed's 'since' mode when they (re)connect.
+"""
+from __future__ import absolute_import
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from threading import Lock
+try:
+    from queue import Full, Queue
+except:
+    from Queue import Full, Queue
+
+from pyaspora.database import db
+
+QUEUE_SIZE = 100
+
+
+class FeedEvents(object):
+    """
+    Keeps a queue for each open stream, keyed by the Contact ID the stream is
+    for.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.listeners = {}
+
+    def listen(self, contact_id):
+        """
+        Register a new stream for Contact ID <contact_id>, returning the Queue
+        that thread IDs will be placed on.
+        """
+        queue = Queue(QUEUE_SIZE)
+        with self.lock:
+            self.listeners.setdefault(contact_id, set()).add(queue)
+        return queue
+
+    def unlisten(self, contact_id, queue):
+        """
+        Deregister a stream when the client goes away.
+        """
+        with self.lock:
+            queues = self.listeners.get(contact_id, set())
+            queues.discard(queue)
+            if not queues:
+                self.listeners.pop(contact_id, None)
+
+    def publish(self, contact_ids, post_id):
+        """
+        Arrange for the Contacts with IDs <contact_ids> to be told that the
+        thread <post_id> has changed, when the current transaction commits.
+        """
+        if not self.listeners:
+            return
+        pending = db.session().info.setdefault('feed_events', [])
+        pending.append((set(contact_ids), post_id))
+
+    def deliver(self, contact_ids, post_id):
+        """
+        Immediately tell any streams for <contact_ids> about <post_id>.
+        """
+        with self.lock:
+            queues = [
+                q for c in contact_ids for q in self.listeners.get(c, ())
+            ]
+        for queue in queues:
+            try:
+                queue.put_nowait(post_id)
+            except Full:
+                pass  # Client isn't keeping up; it can catch up by polling
+
+
+feed_events = FeedEvents()
+
+
+@event.listens_for(Session, 'after_commit')
+def _deliver_pending(session):
+    for contact_ids, post_id in session.info.pop('feed_events', []):
+        feed_events.deliver(contact_ids, post_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop('feed_events', None)
@@ -0,0 +1,208 @@
+"""
+Database models for the materialised per-user news feed.
+"""
+from __future__ import absolute_import
+
+from datetime import datetime
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer
+from sqlalchemy.orm import aliased, relationship
+from sqlalchemy.sql import and_, not_, or_, select
+from sqlalchemy.sql.expression import func
+
+from pyaspora.database import db
+from pyaspora.feed.cache import feed_cache
+from pyaspora.feed.events import feed_events
+
+
+class FeedItem(db.Model):
+    """
+    A top-level Post appearing in the feed of a local Contact. Rows are added
+    when the Post is shared ("fan-out on write") so that displaying the feed
+    is a single range read rather than a search through all Shares.
+
+    Fields:
+        contact - the local Contact whose feed this item is in
+        contact_id - the database primary key of the above
+        post - the top-level Post being displayed
+        post_id - the database primary key of the above
+        updated_at - copy of the Post's thread_modified_at, used to sort
+                     the feed
+        changed_at - when this server last added or bumped the item, by its
+                     own clock, used to poll for changes
+    """
+    __tablename__ = 'feed_items'
+    contact_id = Column(Integer, ForeignKey('contacts.id'), primary_key=True)
+    post_id = Column(Integer, ForeignKey('posts.id'),
+                     primary_key=True, index=True)
+    updated_at = Column(DateTime(timezone=True), nullable=True)
+    changed_at = Column(DateTime(timezone=True), nullable=True, index=True)
+
+    post = relationship('Post')
+
+    __table_args__ = (
+        Index('ix_feed_items_contact_updated', contact_id, updated_at),
+    )
+
+    class Queries:
+        @classmethod
+        def feed_for_contact(cls, contact):
+            return FeedItem.contact_id == contact.id
+
+        @classmethod
+        def sort_key(cls):
+            # Needs the query to join FeedItem.post. Threads that have never
+            # been modified sort by creation time.
+            from pyaspora.post.models import Post
+            return func.coalesce(FeedItem.updated_at, Post.created_at)
+
+    @property
+    def sort_time(self):
+        """
+        The time this item is sorted by, matching FeedItem.Queries.sort_key().
+        """
+        return self.updated_at or self.post.created_at
+
+    @classmethod
+    def add(cls, post, contact_ids):
+        """
+        Place top-level Post <post> into the feeds of the local Contacts with
+        IDs <contact_ids>, unless it is already there or the Contact has
+        hidden it. The caller must commit the session.
+        """
+        from pyaspora.post.models import Post, Share
+
+        contact_ids = set(contact_ids)
+        if post.id:
+            # Everyone already showing the post will see the new Shares
+            existing = cls.contacts_showing(post)
+            feed_cache.invalidate_on_commit(existing)
+            feed_events.publish(existing, post.id)
+            contact_ids -= existing
+        if not contact_ids:
+            return
+        feed_cache.invalidate_on_commit(contact_ids)
+
+        if post.id:
+            hidden = db.session.query(Share.contact_id).filter(and_(
+                Share.post_id == post.id,
+                Share.hidden,
+                Share.contact_id.in_(contact_ids)
+            ))
+            contact_ids -= set(r[0] for r in hidden)
+            feed_events.publish(contact_ids, post.id)
+
+        # The thread may be bumped later in this transaction, so take the
+        # sort key from the Post row when the item is written.
+        sort_key = select([Post.thread_modified_at]). \
+            where(Post.id == post.id).as_scalar() if post.id \
+            else post.thread_modified_at
+        now = datetime.now()
+        for contact_id in contact_ids:
+            db.session.add(cls(
+                contact_id=contact_id,
+                post=post,
+                updated_at=sort_key,
+                changed_at=now
+            ))
+
+    @classmethod
+    def contacts_showing(cls, post):
+        """
+        The set of Contact IDs whose feeds contain Post <post>.
+        """
+        return set(
+            r[0] for r in
+            db.session.query(cls.contact_id).filter(cls.post_id == post.id)
+        )
+
+    @classmethod
+    def bump(cls, post):
+        """
+        Re-sort top-level Post <post> in every feed it appears in, after its
+        thread_modified_at has changed.
+        """
+        if not post.id:
+            return
+        if not feed_cache.is_empty() or feed_events.listeners:
+            showing = cls.contacts_showing(post)
+            feed_cache.invalidate_on_commit(showing)
+            feed_events.publish(showing, post.id)
+        db.session.query(cls).filter(cls.post_id == post.id).update(
+            {
+                cls.updated_at: post.thread_modified_at,
+                cls.changed_at: datetime.now()
+            },
+            synchronize_session=False
+        )
+
+    @classmethod
+    def remove(cls, post, contact):
+        """
+        Take Post <post> out of the feed of Contact <contact>.
+        """
+        feed_cache.invalidate_on_commit([contact.id])
+        db.session.query(cls).filter(and_(
+            cls.post_id == post.id,
+            cls.contact_id == contact.id
+        )).delete(synchronize_session=False)
+
+    @classmethod
+    def rebuild_for_contact(cls, contact):
+        """
+        Recalculate the whole feed for the local Contact <contact> from their
+        Shares, subscriptions and interests. This is needed after the set of
+        people or topics the user follows changes. The caller must commit the
+        session.
+        """
+        from pyaspora.post.models import Post, Share
+        from pyaspora.tag.models import PostTag, Tag
+
+        friend_ids = [f.id for f in contact.friends()]
+        clauses = [Post.Queries.shared_with_contact(contact)]
+        if friend_ids:
+            clauses.append(
+                Post.Queries.authored_by_contacts_and_public(friend_ids))
+        tag_ids = [t.id for t in contact.interests]
+        if tag_ids:
+            clauses.append(Tag.Queries.public_posts_for_tags(tag_ids))
+        my_share = aliased(Share)
+        posts = db.session.query(Post.id). \
+            join(Share). \
+            outerjoin(  # Stuff user hasn't hidden
+                my_share,
+                and_(
+                    Post.id == my_share.post_id,
+                    my_share.contact_id == contact.id
+                )
+            ). \
+            outerjoin(PostTag).outerjoin(Tag). \
+            filter(or_(*clauses)). \
+            filter(or_(my_share.hidden == None, not_(my_share.hidden))). \
+            filter(Post.parent_id == None). \
+            group_by(Post.id). \
+            all()
+
+        feed_cache.invalidate_on_commit([contact.id])
+        db.session.query(cls).filter(cls.contact_id == contact.id). \
+            delete(synchronize_session=False)
+        # Copy the sort key in SQL, as add() and bump() do, so that it is
+        # stored exactly as the Post has it
+        now = datetime.now()
+        for (post_id,) in posts:
+            db.session.add(cls(
+                contact_id=contact.id,
+                post_id=post_id,
+                updated_at=select([Post.thread_modified_at]).
+                where(Post.id == post_id).as_scalar(),
+                changed_at=now
+            ))
+
+    @classmethod
+    def rebuild_all(cls):
+        """
+        Recalculate the feeds for every local user.
+        """
+        from pyaspora.user.models import User
+        for user in db.session.query(User).all():
+            cls.rebuild_for_contact(user.contact)
+            db.session.commit()
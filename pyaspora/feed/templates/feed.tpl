@@ -11,6 +11,9 @@ Display the user's "feed".
 {{button_form(logged_in.link, 'View/edit profile', method='get')}}
 
 {% if feed %}
+    {% if actions.newer %}
+        {{button_form(actions.newer, 'View newer items', method='get')}}
+    {% endif %}
     {{show_feed(feed, logged_in)}}
     {% if actions.more %}
         {{button_form(actions.more, 'View older items', method='get')}}
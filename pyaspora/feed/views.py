@@ -1,68 +1,262 @@
 from __future__ import absolute_import
 
-from flask import Blueprint, request, url_for
-from sqlalchemy.sql import and_, desc, not_, or_
-from sqlalchemy.orm import aliased, contains_eager, joinedload
+from datetime import datetime, timedelta
+from dateutil.parser import parse as parse_datetime
+from dateutil.tz import tzlocal
+from flask import Blueprint, current_app, jsonify, request, Response, \
+    url_for
+from sqlalchemy.sql import and_, or_
+from sqlalchemy.orm import contains_eager, joinedload
+try:
+    from queue import Empty
+except:
+    from Queue import Empty
 
 from pyaspora.database import db
+from pyaspora.feed.cache import feed_cache
+from pyaspora.feed.events import feed_events
+from pyaspora.feed.models import FeedItem
 from pyaspora.post.models import Post, Share
-from pyaspora.post.views import json_posts
-from pyaspora.tag.models import PostTag, Tag
-from pyaspora.user.session import require_logged_in_user
-from pyaspora.utils.rendering import add_logged_in_user_to_data, \
+from pyaspora.post.views import json_posts, requested_formats
+from pyaspora.user.session import require_admin_user, \
+    require_logged_in_user
+from pyaspora.utils.pagination import keyset_page, page_actions
+from pyaspora.utils.rendering import abort, add_logged_in_user_to_data, \
     redirect, render_response
 
 blueprint = Blueprint('feed', __name__, template_folder='templates')
 
 
+def _shares_for_feed(post_ids, contact):
+    """
+    Pick the Share that explains why each Post is in <contact>'s feed,
+    preferring the contact's own Share over a public one.
+    """
+    if not post_ids:
+        return {}
+    shares = db.session.query(Share).filter(and_(
+        Share.post_id.in_(post_ids),
+        or_(Share.contact_id == contact.id, Share.public)
+    ))
+    by_post = {}
+    for share in shares:
+        if share.contact_id == contact.id or share.post_id not in by_post:
+            by_post[share.post_id] = share
+    return by_post
+
+
 @blueprint.route('/', methods=['GET'])
 @require_logged_in_user
 def view(_user):
     """
     Show the logged-in user their own feed.
     """
+    if 'since' in request.args:
+        return _feed_changes(_user, request.args['since'])
+
     from pyaspora.diaspora.models import MessageQueue
     if MessageQueue.has_pending_items(_user):
         return redirect(url_for('diaspora.run_queue', _external=True))
 
     limit = int(request.args.get('limit', 10))
-    friend_ids = [f.id for f in _user.contact.friends()]
-    clauses = [Post.Queries.shared_with_contact(_user.contact)]
-    if friend_ids:
-        clauses.append(
-            Post.Queries.authored_by_contacts_and_public(friend_ids))
-    tag_ids = [t.id for t in _user.contact.interests]
-    if tag_ids:
-        clauses.append(Tag.Queries.public_posts_for_tags(tag_ids))
-    feed_query = or_(*clauses)
-    my_share = aliased(Share)
-    feed = db.session.query(Share).join(Post). \
-        outerjoin(  # Stuff user hasn't hidden
-            my_share,
-            and_(
-                Post.id == my_share.post_id,
-                my_share.contact == _user.contact
-            )
-        ). \
-        outerjoin(PostTag).outerjoin(Tag). \
-        filter(feed_query). \
-        filter(or_(my_share.hidden == None, not_(my_share.hidden))). \
-        filter(Post.parent == None). \
-        order_by(desc(Post.thread_modified_at)). \
-        group_by(Post.id). \
-        options(contains_eager(Share.post)). \
-        options(joinedload(Share.post, Post.diasp)). \
-        limit(limit)
+    page_key = (
+        request.args.get('before'),
+        request.args.get('after'),
+        limit,
+        requested_formats()
+    )
+    data = feed_cache.get(_user.contact_id, page_key)
+    if data is None:
+        generation = feed_cache.generation(_user.contact_id)
+        data = _feed_page(_user, limit)
+        feed_cache.put(_user.contact_id, page_key, data, generation)
+    data = dict(data)
 
-    data = {
-        'feed': json_posts([(s.post, s) for s in feed], _user, True),
+    add_logged_in_user_to_data(data, _user)
+
+    return render_response('feed.tpl', data)
+
+
+def _feed_page(user, limit):
+    """
+    The posts and paging actions for one page of <user>'s feed.
+    """
+    items = db.session.query(FeedItem). \
+        join(FeedItem.post). \
+        filter(FeedItem.Queries.feed_for_contact(user.contact)). \
+        options(contains_eager(FeedItem.post)). \
+        options(joinedload(FeedItem.post, Post.diasp))
+    items = keyset_page(items, FeedItem.Queries.sort_key(), FeedItem.post_id,
+                        limit)
+    shares = _shares_for_feed([i.post_id for i in items], user.contact)
+
+    return {
+        'feed': json_posts(
+            [(i.post, shares.get(i.post_id)) for i in items],
+            user,
+            True
+        ),
         'limit': limit,
-        'actions': {},
+        'actions': page_actions(
+            'feed.view',
+            items,
+            lambda i: (i.sort_time, i.post_id),
+            limit
+        ),
     }
 
-    if len(data['feed']) >= limit:
-        data['actions']['more'] = url_for('feed.view', limit=limit + 10, _external=True)
 
-    add_logged_in_user_to_data(data, _user)
+def _local(when):
+    """
+    <when> as a naive local time, like the datetime.now() it was stored from.
+    """
+    if when.tzinfo:
+        when = when.astimezone(tzlocal()).replace(tzinfo=None)
+    return when
 
-    return render_response('feed.tpl', data)
+
+def _micros(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _make_watermark(when, seen):
+    """
+    A watermark recording the time <when> that the feed has been read up to,
+    plus the (thread ID, changed_at) pairs in <seen> that have already been
+    reported from the FEED_POLL_WINDOW seconds before it.
+    """
+    return '{0}_{1}'.format(when.isoformat(), '.'.join(
+        '{0}-{1}'.format(post_id, _micros(when - changed))
+        for post_id, changed in sorted(seen)
+    ))
+
+
+def _parse_watermark(watermark):
+    """
+    Split a watermark from _make_watermark() into the time and the set of
+    (thread ID, changed_at) pairs already seen.
+    """
+    try:
+        when, seen = watermark.rsplit('_', 1)
+        when = _local(parse_datetime(when))
+        return when, set(
+            (int(post_id), when - timedelta(microseconds=int(offset)))
+            for post_id, offset in (i.split('-') for i in seen.split('.') if i)
+        )
+    except (ValueError, OverflowError):
+        abort(400, 'Invalid watermark')
+
+
+def _feed_changes(user, watermark):
+    """
+    JSON list of the threads in <user>'s feed that have been added or bumped
+    since <watermark>, oldest change first, along with a new watermark to
+    poll with. If there are more than 'limit' changes then 'more' will be
+    true and the client should poll again immediately. An empty watermark
+    returns no threads, just a watermark to start polling from.
+
+    Changes are found by FeedItem.changed_at, which is taken from this
+    server's clock (unlike the thread modification times, which can come
+    from other servers). A change can commit some time after it was stamped,
+    so each poll looks again at the last FEED_POLL_WINDOW seconds before the
+    watermark, and the watermark lists the changes already reported from
+    that window so that they aren't reported twice.
+    """
+    limit = int(request.args.get('limit', 50))
+    window = timedelta(
+        seconds=current_app.config.get('FEED_POLL_WINDOW', 30)
+    )
+    items = db.session.query(FeedItem). \
+        filter(FeedItem.Queries.feed_for_contact(user.contact))
+    if watermark:
+        when, seen = _parse_watermark(watermark)
+        rows = items.filter(FeedItem.changed_at >= when - window). \
+            order_by(FeedItem.changed_at, FeedItem.post_id). \
+            limit(limit + len(seen)).all()
+        more = len(rows) >= limit + len(seen)
+        items = [
+            i for i in rows if (i.post_id, _local(i.changed_at)) not in seen
+        ][:limit]
+        seen.update((i.post_id, _local(i.changed_at)) for i in items)
+    else:
+        # Start from now, treating what is already in the feed as seen
+        when = datetime.now()
+        more = False
+        seen = set(
+            (i.post_id, _local(i.changed_at)) for i in
+            items.filter(FeedItem.changed_at >= when - window)
+        )
+        items = []
+
+    when = max([when] + [_local(i.changed_at) for i in items])
+    seen = set(s for s in seen if s[1] >= when - window)
+
+    data = {
+        'feed': [],
+        'watermark': _make_watermark(when, seen),
+        'more': more,
+    }
+    if items:
+        post_ids = [i.post_id for i in items]
+        posts = dict((p.id, p) for p in db.session.query(Post).
+                     filter(Post.id.in_(post_ids)).
+                     options(joinedload(Post.diasp)))
+        shares = _shares_for_feed(post_ids, user.contact)
+        data['feed'] = json_posts(
+            [(posts[i], shares.get(i)) for i in post_ids],
+            user,
+            True,
+            formats=requested_formats('json')
+        )
+
+    from pyaspora.diaspora.models import MessageQueue
+    if MessageQueue.has_pending_items(user):
+        data['actions'] = {
+            'run_queue': url_for('diaspora.run_queue', _external=True)
+        }
+
+    return render_response(None, data, output_format='json')
+
+
+@blueprint.route('/events', methods=['GET'])
+@require_logged_in_user
+def events(_user):
+    """
+    A Server-Sent Events stream that sends the ID of each thread that is
+    added to, or bumped in, the logged-in user's feed.
+    """
+    contact_id = _user.contact_id
+    keepalive = current_app.config.get('FEED_EVENTS_KEEPALIVE', 30)
+
+    # Don't hold a database connection for the life of the stream
+    db.session.close()
+
+    queue = feed_events.listen(contact_id)
+
+    def _stream():
+        try:
+            yield 'retry: 10000\n\n'
+            while True:
+                try:
+                    post_id = queue.get(timeout=keepalive)
+                except Empty:
+                    yield ': keep-alive\n\n'
+                else:
+                    yield 'event: thread\ndata: {0}\n\n'.format(post_id)
+        finally:
+            feed_events.unlisten(contact_id, queue)
+
+    response = Response(_stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@blueprint.route('/cache', methods=['GET'])
+@require_admin_user
+def cache_stats(_user):
+    """
+    Hit/miss counters for the feed page cache. Only available to the site
+    administrators listed in the ADMINS setting.
+    """
+    return jsonify(feed_cache.stats())
@@ -0,0 +1,58 @@
+"""
+A cache of the parts of a serialised Post that are the same whoever is
+viewing it (the rendered parts and the tags), so that a Post seen by many
+users is only serialised once. The viewer-specific parts (actions, shares and
+comments) are filled in by json_post() for each request.
+
+Cached fragments are shared between responses, so must not be modified. As
+responses may be for different hosts, their links to this server are cached
+without the host (see pyaspora.utils.rendering.portable_url()).
+"""
+from __future__ import absolute_import
+
+from hashlib import sha256
+from sqlalchemy import event, inspect
+from sqlalchemy.sql import select
+
+from pyaspora.content.models import MimePart
+from pyaspora.utils.cache import LRUCache
+
+DEFAULT_SIZE = 10000
+
+post_fragments = LRUCache('POST_FRAGMENT_CACHE_SIZE', DEFAULT_SIZE)
+
+
+def _content_changed(part):
+    """
+    Whether a flushed update to MimePart <part> could change how it displays.
+    Moving the body between the database and the blob store, or recording
+    its hash, doesn't.
+    """
+    state = inspect(part)
+    if state.attrs.type.history.has_changes() or \
+            state.attrs.text_preview.history.has_changes():
+        return True
+    hashes = state.attrs.body_hash.history
+    if not hashes.has_changes():
+        return False
+    old = hashes.deleted[0] if hashes.deleted else None
+    if old is None:
+        bodies = state.attrs._body.history
+        if not bodies.has_changes():
+            return False  # Just recording the hash of the existing body
+        if bodies.deleted and bodies.deleted[0] is not None:
+            old = sha256(bodies.deleted[0]).hexdigest()
+    return not hashes.added or old != hashes.added[0]
+
+
+@event.listens_for(MimePart, 'after_update')
+def _invalidate_fragments(mapper, connection, part):
+    # Parts can be shared between Posts, so drop every Post using it
+    from pyaspora.post.models import PostPart
+    if not _content_changed(part):
+        return
+    post_ids = set(r[0] for r in connection.execute(
+        select([PostPart.post_id]).where(PostPart.mime_part_id == part.id)
+    ))
+    if post_ids:
+        post_fragments.discard(lambda key: key[0] in post_ids)
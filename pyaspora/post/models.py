@@ -1,13 +1,17 @@
 from __future__ import absolute_import
 
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer
-from sqlalchemy.orm import backref, contains_eager, relationship
-from sqlalchemy.sql import and_, not_
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, \
+    event
+from sqlalchemy.orm import aliased, backref, contains_eager, joinedload, \
+    relationship
+from sqlalchemy.sql import and_, desc, exists, not_, or_
 from sqlalchemy.sql.expression import func
 
 from pyaspora.content.models import MimePart
 from pyaspora.contact.models import Contact
 from pyaspora.database import db
+from pyaspora.feed.models import FeedItem
+from pyaspora.utils.pagination import comparable_time
 
 
 class Share(db.Model):
@@ -80,6 +84,17 @@ class PostPart(db.Model):
             filter(cls.post_id.in_(post_ids)). \
             options(contains_eager(cls.mime_part))
 
+    @classmethod
+    def get_parts_for_mime_parts(cls, mime_part_ids):
+        """
+        Fetch all the PostParts, with MimeParts pre-loaded, that link to the
+        MimeParts with IDs <mime_part_ids>.
+        """
+        return db.session.query(cls). \
+            join(MimePart). \
+            filter(cls.mime_part_id.in_(mime_part_ids)). \
+            options(contains_eager(cls.mime_part))
+
 
 class Post(db.Model):
     """
@@ -93,6 +108,9 @@ class Post(db.Model):
         parent - if this Post is a comment on another Post, this links to the
                  parent Post. May be None.
         parent_id - the database primary key for the above
+        root_post - if this Post is a comment, the top-level Post of the
+                    thread it is in. None for top-level Posts.
+        root_id - the database primary key for the above
         thread_modified_at - last modification of the post or children, only
                              set on posts with no parent (top-level items)
         shares - Shares of this Post (occurrences in feeds/on walls)
@@ -105,17 +123,26 @@ class Post(db.Model):
                        nullable=False, index=True)
     parent_id = Column(Integer, ForeignKey('posts.id'), nullable=True,
                        default=None, index=True)
+    root_id = Column(Integer, ForeignKey('posts.id'), nullable=True,
+                     default=None, index=True)
     created_at = Column(DateTime(timezone=True),
                         nullable=False, default=func.now())
     thread_modified_at = Column(DateTime(timezone=True), nullable=True)
 
     author = relationship(Contact, backref='posts')
     parts = relationship(PostPart, backref='post', order_by=PostPart.order)
-    children = relationship('Post',
+    children = relationship('Post', foreign_keys=[parent_id],
                             backref=backref('parent', remote_side=[id]))
+    root_post = relationship('Post', foreign_keys=[root_id],
+                             remote_side=[id])
     shares = relationship(Share, backref='post')
 
     class Queries:
+        @classmethod
+        def thread_sort_key(cls):
+            # Threads that have never been modified sort by creation time
+            return func.coalesce(Post.thread_modified_at, Post.created_at)
+
         @classmethod
         def public_wall_for_contact(cls, contact):
             return and_(
@@ -150,6 +177,128 @@ class Post(db.Model):
         def children_for_posts(cls, post_ids):
             return Post.parent_id.in_(post_ids)
 
+        @classmethod
+        def visible_to_contact(cls, contact):
+            return Post._visible_to(Post.id, contact.id if contact else None)
+
+    @classmethod
+    def _visible_to(cls, post_id, viewer_id=None):
+        """
+        SQL condition that the Post with ID <post_id> is visible to the
+        Contact with ID <viewer_id> (or to the public if None), being public
+        or shared with the viewer, and not hidden by the viewer.
+        """
+        seen = aliased(Share)
+        if viewer_id:
+            shared = or_(seen.public, seen.contact_id == viewer_id)
+        else:
+            shared = seen.public
+        visible = exists().where(and_(seen.post_id == post_id, shared))
+        if viewer_id:
+            hidden = aliased(Share)
+            visible = and_(visible, not_(exists().where(and_(
+                hidden.post_id == post_id,
+                hidden.contact_id == viewer_id,
+                hidden.hidden
+            ))))
+        return visible
+
+    @classmethod
+    def get_comments(cls, post_ids, viewer_id=None, per_parent=None):
+        """
+        Fetch all the comments (and replies to those comments, recursively)
+        on the Posts with IDs <post_ids> that the Contact with ID <viewer_id>
+        can see, in a single query. If <per_parent> is set then only the
+        newest <per_parent> comments on each Post are fetched.
+
+        Returns a list of (post, share, count) tuples, where <share> is the
+        Share through which the viewer sees the Post (preferring the viewer's
+        own Share to a public one), and <count> is the number of visible
+        comments on the Post's parent.
+        """
+        if not post_ids:
+            return []
+
+        thread = db.session.query(
+            Post.id.label('id'),
+            Post.parent_id.label('parent_id'),
+            Post.created_at.label('created_at')
+        ).filter(and_(
+            Post.Queries.children_for_posts(post_ids),
+            cls._visible_to(Post.id, viewer_id)
+        )).cte('thread', recursive=True)
+        child = aliased(Post)
+        thread = thread.union_all(
+            db.session.query(child.id, child.parent_id, child.created_at).
+            join(thread, child.parent_id == thread.c.id).
+            filter(cls._visible_to(child.id, viewer_id))
+        )
+
+        ranked = db.session.query(
+            thread.c.id.label('id'),
+            func.row_number().over(
+                partition_by=thread.c.parent_id,
+                order_by=[
+                    desc(comparable_time(thread.c.created_at)),
+                    desc(thread.c.id)
+                ]
+            ).label('rank'),
+            func.count(thread.c.id).over(
+                partition_by=thread.c.parent_id
+            ).label('siblings')
+        ).subquery()
+
+        public_share = aliased(Share)
+        first_public = db.session.query(func.min(Share.contact_id)). \
+            filter(and_(Share.post_id == Post.id, Share.public)). \
+            correlate(Post).as_scalar()
+        query = db.session.query(Post, public_share, ranked.c.siblings). \
+            join(ranked, ranked.c.id == Post.id). \
+            outerjoin(public_share, and_(
+                public_share.post_id == Post.id,
+                public_share.contact_id == first_public
+            )). \
+            options(joinedload(Post.diasp))
+        if viewer_id:
+            my_share = aliased(Share)
+            query = query.add_entity(my_share).outerjoin(my_share, and_(
+                my_share.post_id == Post.id,
+                my_share.contact_id == viewer_id
+            ))
+        if per_parent:
+            query = query.filter(ranked.c.rank <= per_parent)
+
+        return [
+            (row[0], row[3] if viewer_id and row[3] else row[1], row[2])
+            for row in query
+        ]
+
+    @classmethod
+    def backfill_roots(cls):
+        """
+        Fill in root_id for comments created before it was recorded, one
+        thread level per pass. Returns the number of Posts updated.
+        """
+        parent = aliased(Post)
+        updated = 0
+        while True:
+            parent_root = db.session.query(
+                func.coalesce(parent.root_id, parent.id)
+            ).filter(parent.id == Post.parent_id).correlate(Post).as_scalar()
+            has_root = db.session.query(parent.id).filter(and_(
+                parent.id == Post.parent_id,
+                or_(parent.parent_id == None, parent.root_id != None)
+            )).correlate(Post).exists()
+            count = db.session.query(Post).filter(and_(
+                Post.parent_id != None,
+                Post.root_id == None,
+                has_root
+            )).update({Post.root_id: parent_root}, synchronize_session=False)
+            db.session.commit()
+            if not count:
+                return updated
+            updated += count
+
     @classmethod
     def get(cls, postid):
         """
@@ -157,15 +306,78 @@ class Post(db.Model):
         """
         return db.session.query(cls).get(postid)
 
+    @classmethod
+    def viewable_ids(cls, post_ids, contact=None):
+        """
+        The set of IDs, out of <post_ids>, of the Posts that the Contact
+        <contact> (or the public, if None) is permitted to view. This follows
+        the same rules as has_permission_to_view(), but checks all the Posts
+        in at most two queries.
+        """
+        if not post_ids:
+            return set()
+
+        public = db.session.query(Share.post_id).filter(and_(
+            Share.post_id.in_(post_ids),
+            Share.public
+        )).distinct()
+        viewable = set(r[0] for r in public)
+
+        if contact:
+            own = db.session.query(Post.id, Post.author_id, Share.hidden). \
+                outerjoin(Share, and_(
+                    Share.post_id == Post.id,
+                    Share.contact_id == contact.id
+                )). \
+                filter(Post.id.in_(post_ids))
+            for post_id, author_id, hidden in own:
+                if hidden:
+                    # Hidden status trumps everything else
+                    viewable.discard(post_id)
+                elif hidden is not None or author_id == contact.id:
+                    viewable.add(post_id)
+
+        return viewable
+
+    @classmethod
+    def part_is_viewable(cls, mime_part_id, contact=None):
+        """
+        Whether the Contact <contact> (or the public, if None) is permitted to
+        view any Post containing the MimePart with ID <mime_part_id>. This
+        follows the same rules as has_permission_to_view(), in one query.
+        """
+        public = aliased(Share)
+        is_public = exists().where(and_(
+            public.post_id == Post.id,
+            public.public
+        ))
+        query = db.session.query(PostPart.post_id). \
+            join(Post, Post.id == PostPart.post_id). \
+            filter(PostPart.mime_part_id == mime_part_id)
+        if contact:
+            mine = aliased(Share)
+            query = query.outerjoin(mine, and_(
+                mine.post_id == Post.id,
+                mine.contact_id == contact.id
+            )).filter(or_(
+                and_(mine.post_id != None, not_(mine.hidden)),
+                and_(mine.post_id == None, or_(
+                    Post.author_id == contact.id,
+                    is_public
+                ))
+            ))
+        else:
+            query = query.filter(is_public)
+        return db.session.query(query.exists()).scalar()
+
     def has_permission_to_view(self, contact=None, share=False):
         """
         Whether the Contact <contact> is permitted to view this post.
         """
-        if contact:
-            # Check for shares to the contact
-            if share is False:  # we don't use None as there may be no Share
-                share = self.shared_with(contact)
+        if share is False:  # we don't use None as there may be no Share
+            return self.id in Post.viewable_ids([self.id], contact)
 
+        if contact:
             if share:
                 # Hidden status trumps everything else
                 return not share.hidden
@@ -179,21 +391,16 @@ class Post(db.Model):
 
         return bool(self.is_public())
 
-    def viewable_children(self, contact=None):
-        """
-        List of child posts that the Contact <contact> is permitted to view
-        """
-        return [child for child in self.children
-                if child.has_permission_to_view(contact)]
-
     def add_part(self, mime_part, inline=False, order=1):
         """
         Adds MIMEPart <mimepart> to this Post, creating the linking PostPart
         (which is returned).
         """
+        from pyaspora.content.rendering import render_on_commit
         link = PostPart(post=self, mime_part=mime_part, inline=inline,
                         order=order)
         db.session.add(link)
+        render_on_commit(link)
         return link
 
     def is_public(self):
@@ -229,6 +436,7 @@ class Post(db.Model):
                 DiasporaPost.get_for_post(self).reshare(contacts, reshare_of)
             else:
                 DiasporaPost.get_for_post(self).send_to(contacts)
+            db.session.commit()  # write out queued deliveries
 
     def implicit_share(self, contacts, reshare_of=None):
         """
@@ -254,10 +462,39 @@ class Post(db.Model):
                                      public=show_on_wall))
                 if contact.user and contact.id != self.author_id:
                     contact.user.notify_event(commit=False)
+        if self.parent is None:
+            self._add_to_feeds(new_shares, show_on_wall)
         if remote and self.author.user:
             # Only announce locally-generated content
             self._send_to_remotes(new_shares, reshare_of)
 
+    def _add_to_feeds(self, contacts, public):
+        """
+        Put this top-level Post into the feed of every local user who can now
+        see it because it was shared with Contacts <contacts>.
+        """
+        from pyaspora.roster.models import Subscription
+        from pyaspora.tag.models import Interest
+        from pyaspora.user.models import User
+
+        feed_ids = set(c.id for c in contacts if c.user)
+        if public and contacts:
+            # Local users following a contact see their public shares
+            followers = db.session.query(Subscription.from_id). \
+                join(User, User.contact_id == Subscription.from_id). \
+                filter(Subscription.to_id.in_([c.id for c in contacts]))
+            feed_ids.update(r[0] for r in followers)
+
+            # ...and local users see public posts on topics of interest
+            tag_ids = [t.id for t in self.tags if t.id]
+            if tag_ids:
+                interested = db.session.query(Interest.contact_id). \
+                    join(User, User.contact_id == Interest.contact_id). \
+                    filter(Interest.tag_id.in_(tag_ids))
+                feed_ids.update(r[0] for r in interested)
+
+        FeedItem.add(self, feed_ids)
+
     def shared_with(self, contact):
         """
         Returns a boolean indicating whether this Post has already been shared
@@ -272,6 +509,7 @@ class Post(db.Model):
         """
         Stop this post appearing in the feed of the user.
         """
+        FeedItem.remove(self, user.contact)
         share = self.shared_with(user.contact)
         if share:
             share.hidden = True
@@ -287,12 +525,22 @@ class Post(db.Model):
             hidden=True
         ))
 
+    @property
+    def thread_sort_time(self):
+        """
+        The time this thread is sorted by in feeds, matching
+        Post.Queries.thread_sort_key().
+        """
+        return self.thread_modified_at or self.created_at
+
     def root(self):
         """
         The top-level post that started this thread.
         """
+        if self.root_post:
+            return self.root_post
         post = self
-        while post.parent:
+        while post.parent:  # Not yet back-filled
             post = post.parent
         return post
 
@@ -309,3 +557,36 @@ class Post(db.Model):
             post.thread_modified_at = func.now()
         if post.id != self.id:
             db.session.add(post)
+        FeedItem.bump(post)
+
+
+def _set_subtree_root(post, root):
+    """
+    Make <root> the thread root of <post> and of every comment below it, or
+    make <post> the root of its subtree if <root> is None.
+    """
+    post.root_post = root
+    if post.id is None:
+        return  # Not saved yet, so can't have saved comments
+    root = root or post
+    with db.session.no_autoflush:
+        todo = list(post.children)
+        while todo:
+            child = todo.pop()
+            child.root_post = root
+            todo.extend(child.children)
+
+
+@event.listens_for(Post.children, 'append')
+def _set_root(parent, post, initiator):
+    """
+    Keep Post.root_post in step with Post.parent, so that the top of a thread
+    can be found without walking up it. If a Post with comments is moved,
+    its whole subtree moves to the new thread.
+    """
+    _set_subtree_root(post, parent.root())
+
+
+@event.listens_for(Post.children, 'remove')
+def _clear_root(parent, post, initiator):
+    _set_subtree_root(post, None)
@@ -0,0 +1,26 @@
+{#
+Display a page of the comments on a Post.
+#}
+{% extends "layout.tpl" %}
+{% from 'widgets.tpl' import button_form, show_feed %}
+
+{% block content %}
+<h2>Comments</h2>
+
+<div id="related_item">
+    {{show_feed([post])}}
+</div>
+
+{% if comments %}
+    {% if actions.more %}
+        {{button_form(actions.more, 'View older comments', method='get')}}
+    {% endif %}
+    {{show_feed(comments, logged_in)}}
+    {% if actions.newer %}
+        {{button_form(actions.newer, 'View newer comments', method='get')}}
+    {% endif %}
+{% else %}
+    <p>There are no comments on this item.</p>
+{% endif %}
+
+{% endblock %}
@@ -1,26 +1,38 @@
 from __future__ import absolute_import
 
-from flask import Blueprint, request, url_for
+from flask import Blueprint, current_app, request, url_for
 from json import dumps
 from sqlalchemy.orm import joinedload
 from sqlalchemy.sql import and_, not_, or_
 
 from pyaspora.content.models import MimePart
-from pyaspora.content.rendering import render, renderer_exists
+from pyaspora.content.rendering import load_bodies, load_renderings, \
+    render, render_markdown, render_portable, renderer_exists
 from pyaspora.contact.models import Contact
 from pyaspora.contact.views import json_contact
 from pyaspora.database import db
+from pyaspora.post.cache import post_fragments
 from pyaspora.post.models import Post, PostPart, Share
 from pyaspora.post.targets import target_list, targets_by_name
+from pyaspora.utils.pagination import keyset_page, make_cursor, \
+    page_actions
 from pyaspora.utils.rendering import abort, add_logged_in_user_to_data, \
-    redirect, render_datetime, render_response
+    localise_urls, portable_url, redirect, render_datetime, render_response
 from pyaspora.utils.validation import check_attachment_is_safe, post_param
-from pyaspora.user.session import require_logged_in_user
+from pyaspora.user.session import logged_in_user, require_logged_in_user
 from pyaspora.tag.models import PostTag, Tag
 from pyaspora.tag.views import json_tag
 
 blueprint = Blueprint('posts', __name__, template_folder='templates')
 
+# The formats a part's body can be rendered in, for json_part()
+BODY_FORMATS = ('text', 'html')
+FORMAT_TYPES = {'text': 'text/plain', 'html': 'text/html'}
+
+# Fields whose value can include Posts, and so Post bodies
+POST_FIELDS = ('feed', 'post', 'comments', 'children', 'object', 'parts',
+               'body')
+
 
 def _get_cached(cache, entry_type, entry_id):
     if entry_id not in cache[entry_type]:
@@ -28,20 +40,49 @@ def _get_cached(cache, entry_type, entry_id):
     return cache[entry_type][entry_id]
 
 
-def _base_cache():
+def _base_cache(formats=None):
     return {
         'contact': {},
-        'post': {}
+        'post': {},
+        'formats': requested_formats() if formats is None else tuple(formats)
     }
 
 
-def json_posts(posts_and_shares, viewing_as=None, show_shares=False):
+def requested_formats(output_format=None):
+    """
+    The part body formats ('text' and/or 'html') that the current request
+    will use. HTML pages only show the 'html' body. JSON clients get both,
+    unless they ask for a sparse fieldset with the 'fields' parameter, in
+    which case only the formats that could be in the response are rendered.
+    <output_format> is the format of the response, for views that don't
+    follow the 'alt' parameter.
+    """
+    if (output_format or request.args.get('alt', 'html')) != 'json':
+        return ('html',)
+    fields = request.args.get('fields')
+    if not fields:
+        return BODY_FORMATS
+
+    formats = set()
+    for path in fields.split(','):
+        steps = path.strip().split('.')
+        if len(steps) > 1 and steps[-2] == 'body':
+            formats.add(steps[-1])
+        elif steps[-1] in POST_FIELDS:
+            return BODY_FORMATS
+    return tuple(f for f in BODY_FORMATS if f in formats)
+
+
+def json_posts(posts_and_shares, viewing_as=None, show_shares=False,
+               formats=None):
     """
     Run a list of (post, share) pairs through json_post, giving a list
     of for-serialisation views of Posts. This call is more efficient than
-    calling json_post() repeatedly as data is cached.
+    calling json_post() repeatedly as data is cached. <formats> is a list of
+    the part body formats to render (see json_part()), defaulting to those
+    the request needs.
     """
-    cache = _base_cache()
+    cache = _base_cache(formats)
     res = [
         json_post(p, viewing_as, s, cache=cache, children=False)
         for p, s in posts_and_shares
@@ -51,51 +92,114 @@ def json_posts(posts_and_shares, viewing_as=None, show_shares=False):
     return res
 
 
-def _fill_children(c, viewing_as):
+def _child_query(parent_ids, viewing_as):
+    """
+    Query for the child Posts of the Posts with IDs <parent_ids> that the
+    Contact <viewing_as> (or the public, if None) may be able to see.
+    """
+    return db.session.query(Post).filter(and_(
+        Post.Queries.children_for_posts(parent_ids),
+        Post.Queries.visible_to_contact(viewing_as)
+    ))
+
+
+def _shares_for_children(posts, viewing_as):
+    """
+    The Share through which <viewing_as> sees each Post in <posts>, keyed by
+    Post ID, preferring the viewer's own Share over a public one.
+    """
+    if not posts:
+        return {}
+    shares = Share.get_for_posts([p.id for p in posts])
+    if viewing_as:
+        shares = shares.filter(or_(
+            Share.public,
+            Share.contact_id == viewing_as.id
+        ))
+    else:
+        shares = shares.filter(Share.public)
+    by_post = {}
+    for share in shares:
+        if (viewing_as and share.contact_id == viewing_as.id) or \
+                share.post_id not in by_post:
+            by_post[share.post_id] = share
+    return by_post
+
+
+def _fill_children(c, viewing_as, limit=False):
+    """
+    Load the comments for every Post in cache <c>, recursively, in a single
+    query. Only the newest <limit> (by default COMMENTS_PER_THREAD) comments
+    on each Post are loaded; if there are more, the 'more_comments' action
+    links to the rest. A <limit> of None loads every comment.
+    """
     if 'post' not in c:
         return
 
-    while True:
-        fetch_ids = [k for k, v in c['post'].items() if v['children'] is None]
-        if not fetch_ids:
-            break
-        child_posts = db.session.query(Post).join(Share). \
-            filter(Post.Queries.children_for_posts(fetch_ids)). \
-            options(joinedload(Post.diasp)). \
-            order_by(Post.created_at).add_entity(Share)
-        if viewing_as:
-            child_posts = child_posts.filter(
-                or_(Share.public, Share.contact == viewing_as)
-            )
-        else:
-            child_posts = child_posts.filter(Share.public)
-        for i in fetch_ids:
-            c['post'][i]['children'] = []
-        for post, share in child_posts:
-            can_view = post.has_permission_to_view(
-                viewing_as,
-                share=share
+    if limit is False:
+        limit = current_app.config.get('COMMENTS_PER_THREAD', 5)
+    fetch_ids = [k for k, v in c['post'].items() if v['children'] is None]
+    for i in fetch_ids:
+        c['post'][i]['children'] = []
+        c['post'][i]['children_count'] = 0
+
+    comments = Post.get_comments(
+        fetch_ids,
+        viewing_as.contact_id if viewing_as else None,
+        limit
+    )
+
+    # The cap is applied to each parent's comments separately, so replies to
+    # a comment that didn't make the cut can still be returned. Only keep the
+    # comments that are reachable from the Posts being shown.
+    by_parent = {}
+    for row in comments:
+        by_parent.setdefault(row[0].parent_id, []).append(row)
+    comments = []
+    parent_ids = list(fetch_ids)
+    while parent_ids:
+        for row in by_parent.pop(parent_ids.pop(), []):
+            comments.append(row)
+            parent_ids.append(row[0].id)
+    comments.sort(key=lambda row: (row[0].created_at, row[0].id))
+
+    # Serialise every comment before attaching any to its parent, as a reply
+    # from a remote pod may be timestamped before the comment it replies to.
+    serialised = []
+    for post, share, count in comments:
+        data = json_post(post, viewing_as, share, children=False, cache=c)
+        data['children'] = []
+        data['children_count'] = 0
+        serialised.append((post, data, count))
+
+    oldest = {}
+    for post, data, count in serialised:
+        oldest.setdefault(post.parent_id, post)
+        parent = c['post'][post.parent_id]
+        parent['children_count'] = count
+        parent['children'].append(data)
+
+    for i, post in oldest.items():
+        data = c['post'][i]
+        if data['children_count'] > len(data['children']):
+            data['actions']['more_comments'] = url_for(
+                'posts.comments',
+                post_id=i,
+                before=make_cursor(post.created_at, post.id),
+                _external=True
             )
-            if can_view:
-                c['post'][post.parent_id]['children'].append(
-                    json_post(
-                        post,
-                        viewing_as,
-                        share,
-                        children=False,
-                        cache=c
-                    )
-                )
 
 
-def json_post(post, viewing_as=None, share=None, children=True, cache=None):
+def json_post(post, viewing_as=None, share=None, children=True, cache=None,
+              formats=None):
     """
     Turn a Post in sensible representation for serialisation, from the view of
     Contact 'viewing_as', or the public if not provided. If a Share is
     provided then additional actions are provided. If 'children' is False then
-    child Posts of this Post will not be fetched.
+    child Posts of this Post will not be fetched. 'formats' is as for
+    json_posts().
     """
-    c = cache or _base_cache()
+    c = cache or _base_cache(formats)
 
     data = _get_cached(c, 'post', post.id)
     data.update({
@@ -103,28 +207,18 @@ def json_post(post, viewing_as=None, share=None, children=True, cache=None):
         'author': _get_cached(c, 'contact', post.author_id),
         'parts': [],
         'children': None,
+        'children_count': None,
         'created_at': render_datetime(post.created_at),
         'actions': {
             'share': None,
             'comment': None,
             'hide': None,
+            'more_comments': None,
         },
         'tags': [],
         'shares': None
     })
 
-    if children:
-        sorted_children = sorted(post.viewable_children(viewing_as),
-                                 key=lambda p: p.created_at)
-        data['children'] = [
-            json_post(
-                p,
-                viewing_as,
-                p.shared_with(viewing_as) if viewing_as else None,
-                cache=c
-            ) for p in sorted_children
-        ]
-
     if viewing_as:
         data['actions']['comment'] = url_for('posts.comment',
                                              post_id=post.id, _external=True)
@@ -137,6 +231,8 @@ def json_post(post, viewing_as=None, share=None, children=True, cache=None):
                                               post_id=post.id, _external=True)
 
     if not cache:
+        if children:
+            _fill_children(c, viewing_as, limit=None)
         _fill_cache(c, bool(share))
 
     return data
@@ -144,14 +240,11 @@ def json_post(post, viewing_as=None, share=None, children=True, cache=None):
 
 def _fill_cache(c, show_shares=False):
     # Fill the cache in bulk, which will also fill the entries
-    post_ids = c['post'].keys()
+    post_ids = list(c['post'].keys())
     if post_ids:
-        for post_tag in PostTag.get_tags_for_posts(post_ids):
-            c['post'][post_tag.post_id]['tags'].append(json_tag(post_tag.tag))
-        post_parts = PostPart.get_parts_for_posts(post_ids). \
-            order_by(PostPart.order)
-        for post_part in post_parts:
-            c['post'][post_part.post_id]['parts'].append(json_part(post_part))
+        fragments = _post_fragments(post_ids, c['formats'])
+        for post_id, fragment in fragments.items():
+            c['post'][post_id].update(fragment)
         if show_shares:
             for post_share in Share.get_for_posts(post_ids):
                 post_id = post_share.post_id
@@ -167,6 +260,69 @@ def _fill_cache(c, show_shares=False):
             c['contact'][contact.id].update(json_contact(contact))
 
 
+def _post_fragments(post_ids, formats):
+    """
+    The viewer-independent parts ('parts' and 'tags') of the serialisation of
+    each of the Posts with IDs <post_ids>, keyed by Post ID. These come from
+    the fragment cache where possible. The cache is shared between requests
+    made to different hosts, so holds portable links (see portable_url()),
+    which are filled in for this request.
+    """
+    fragments = {}
+    for post_id in post_ids:
+        cached = post_fragments.get((post_id, formats))
+        if cached:
+            fragments[post_id] = cached[0]
+
+    missing = [i for i in post_ids if i not in fragments]
+    if missing:
+        fragments.update(_build_fragments(missing, formats))
+    return dict(
+        (post_id, _localise_fragment(fragment))
+        for post_id, fragment in fragments.items()
+    )
+
+
+def _build_fragments(post_ids, formats):
+    built = dict((i, {'parts': [], 'tags': []}) for i in post_ids)
+    for post_tag in PostTag.get_tags_for_posts(post_ids):
+        built[post_tag.post_id]['tags'].append(
+            json_tag(post_tag.tag, portable=True)
+        )
+    post_parts = PostPart.get_parts_for_posts(post_ids). \
+        order_by(PostPart.order).all()
+    load_renderings(post_parts)
+    load_bodies(post_parts, [FORMAT_TYPES[f] for f in formats])
+    if 'html' in formats:
+        render_markdown(post_parts)
+    for post_part in post_parts:
+        built[post_part.post_id]['parts'].append(
+            json_part(post_part, formats, portable=True)
+        )
+
+    for post_id, fragment in built.items():
+        post_fragments.put((post_id, formats), fragment)
+    return built
+
+
+def _localise_fragment(fragment):
+    # Copies, as the cached fragment is shared
+    return {
+        'parts': [_localise_part(p) for p in fragment['parts']],
+        'tags': [
+            dict(t, link=localise_urls(t['link'])) for t in fragment['tags']
+        ]
+    }
+
+
+def _localise_part(part):
+    return dict(
+        part,
+        link=localise_urls(part['link']),
+        body=dict((f, localise_urls(b)) for f, b in part['body'].items())
+    )
+
+
 def json_share(share, cache=None):
     """
     Turn a Share into a sensible format for serialisation.
@@ -180,20 +336,33 @@ def json_share(share, cache=None):
     }
 
 
-def json_part(part):
+def json_part(part, formats=BODY_FORMATS, portable=False):
     """
-    Turn a PostPart into a sensible format for serialisation.
+    Turn a PostPart into a sensible format for serialisation. Only the body
+    formats in <formats> are rendered; the others are None. If only HTML is
+    wanted but the part has no HTML rendering, the text is rendered too, as
+    templates fall back to it. If <portable> is set, links to this server
+    are left without its host (see portable_url()), so that the result can
+    be cached.
     """
-    url = url_for('content.raw', part_id=part.mime_part.id, _external=True)
+    if portable:
+        url = portable_url('content.raw', part_id=part.mime_part.id)
+        do_render = render_portable
+    else:
+        url = url_for('content.raw', part_id=part.mime_part.id,
+                      _external=True)
+        do_render = render
+    body = dict((f, None) for f in BODY_FORMATS)
+    if 'html' in formats:
+        body['html'] = do_render(part, FORMAT_TYPES['html'])
+    if 'text' in formats or ('html' in formats and not body['html']):
+        body['text'] = do_render(part, FORMAT_TYPES['text'])
     return {
         'inline': part.inline,
         'mime_type': part.mime_part.type,
         'text_preview': part.mime_part.text_preview,
         'link': url,
-        'body': {
-            'text': render(part, 'text/plain', url),
-            'html': render(part, 'text/html', url),
-        }
+        'body': body
     }
 
 
@@ -225,6 +394,47 @@ def share(post_id, _user):
     return render_response('posts_create_form.tpl', data)
 
 
+@blueprint.route('/<int:post_id>/comments', methods=['GET'])
+def comments(post_id):
+    """
+    Page through the comments on an existing Post, newest first.
+    """
+    viewing_as = logged_in_user()
+    contact = viewing_as.contact if viewing_as else None
+    post = Post.get(post_id)
+    if not post:
+        abort(404, 'No such post', force_status=True)
+    if not post.has_permission_to_view(contact):
+        abort(403, 'Forbidden')
+
+    limit = int(request.args.get('limit', 25))
+    children = keyset_page(
+        _child_query([post.id], contact).options(joinedload(Post.diasp)),
+        Post.created_at,
+        Post.id,
+        limit
+    )
+    shares = _shares_for_children(children, contact)
+
+    data = {
+        'post': json_post(post, viewing_as, children=False),
+        'comments': json_posts(
+            [(p, shares.get(p.id)) for p in reversed(children)],
+            viewing_as
+        ),
+        'limit': limit,
+        'actions': page_actions(
+            'posts.comments',
+            children,
+            lambda p: (p.created_at, p.id),
+            limit,
+            post_id=post.id
+        ),
+    }
+    add_logged_in_user_to_data(data, viewing_as)
+    return render_response('posts_comments.tpl', data)
+
+
 @blueprint.route('/<int:post_id>/comment', methods=['GET'])
 @require_logged_in_user
 def comment(post_id, _user):
@@ -393,9 +603,9 @@ def create(_user):
             check_attachment_is_safe(attachment)
             attachment_part = MimePart(
                 type=attachment.mimetype,
-                body=attachment.stream.read(),
                 text_preview=attachment.filename
             )
+            attachment_part.set_body_from_stream(attachment.stream)
             post.add_part(attachment_part, order=1,
                           inline=bool(renderer_exists(attachment.mimetype)))
 
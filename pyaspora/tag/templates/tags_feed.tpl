@@ -8,7 +8,13 @@ Display the feed of posts about a particular Tag topic.
 <h2>Latest posts for: {{name}}</h2>
 
 {% if feed %}
+    {% if actions.newer %}
+        {{button_form(actions.newer, 'View newer items', method='get')}}
+    {% endif %}
     {{show_feed(feed)}}
+    {% if actions.more %}
+        {{button_form(actions.more, 'View older items', method='get')}}
+    {% endif %}
 {% else %}
     <p>No posts for this topic.</p>
 {% endif %}
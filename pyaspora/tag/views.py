@@ -3,27 +3,33 @@ Views relating to tags.
 """
 from __future__ import absolute_import
 
-from flask import Blueprint, url_for
-from sqlalchemy.sql import desc
+from flask import Blueprint, request, url_for
 
 from pyaspora.database import db
 from pyaspora.tag.models import PostTag, Tag
 from pyaspora.user.session import require_logged_in_user
+from pyaspora.utils.pagination import keyset_page, page_actions
 from pyaspora.utils.rendering import abort, add_logged_in_user_to_data, \
-    render_response
+    portable_url, render_response
 
 blueprint = Blueprint('tags', __name__, template_folder='templates')
 
 
-def json_tag(tag):
+def json_tag(tag, portable=False):
     """
-    Sensible JSON data structure for a Tag.
+    Sensible JSON data structure for a Tag. If <portable> is set, the link
+    is left without this server's host (see portable_url()), so that it can
+    be cached.
     """
+    if portable:
+        link = portable_url('tags.feed', tag_name=tag.name)
+    else:
+        link = url_for('tags.feed', tag_name=tag.name, _external=True)
     return {
         'id': tag.id,
         'name': tag.name,
         'feed': None,
-        'link': url_for('tags.feed', tag_name=tag.name, _external=True)
+        'link': link
     }
 
 
@@ -41,17 +47,24 @@ def feed(tag_name, _user):
         abort(404, 'No such tag')
 
     data = json_tag(tag)
+    limit = int(request.args.get('limit', 25))
 
     posts = db.session.query(Post). \
         join(PostTag). \
         join(Tag). \
         join(Share). \
         filter(Tag.Queries.public_posts_for_tags([tag.id])). \
-        order_by(desc(Post.thread_modified_at)). \
-        group_by(Post.id). \
-        limit(100)
+        group_by(Post.id)
+    posts = keyset_page(posts, Post.Queries.thread_sort_key(), Post.id, limit)
 
     data['feed'] = json_posts([(p, None) for p in posts])
+    data['actions'] = page_actions(
+        'tags.feed',
+        posts,
+        lambda p: (p.thread_sort_time, p.id),
+        limit,
+        tag_name=tag.name
+    )
 
     add_logged_in_user_to_data(data, _user)
 
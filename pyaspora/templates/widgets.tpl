@@ -101,6 +101,9 @@ Standard widgets
         {{button_form(post.actions.hide,'Hide')}}
     {% endif %}
 
+    {% if post.actions.more_comments %}
+        {{button_form(post.actions.more_comments, 'View all %d comments' % post.children_count, method='get')}}
+    {% endif %}
     {% if post.children %}
         {{ loop(post.children) }}
     {% endif %}
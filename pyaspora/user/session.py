@@ -57,6 +57,23 @@ def require_logged_in_user(fn):
     return _inner
 
 
+def require_admin_user(fn):
+    """
+    Decorator that requires the logged in user be one of the site
+    administrators listed in the ADMINS setting. Passes the logged in user to
+    the target function as <_user>.
+    """
+    @wraps(fn)
+    def _inner(*args, **kwargs):
+        user = logged_in_user()
+        if not user:
+            abort(401, 'Not logged in')
+        if user.email not in current_app.config.get('ADMINS', []):
+            abort(403, 'Not an administrator')
+        return fn(*args, _user=user, **kwargs)
+    return _inner
+
+
 def log_in_user(email, password):
     """
     Check the credentials are correct for logging in and set up session.
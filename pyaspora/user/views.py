@@ -229,9 +229,9 @@ def edit(_user):
 
         attachment_part = MimePart(
             type=attachment.mimetype,
-            body=attachment.stream.read(),
             text_preview=attachment.filename
         )
+        attachment_part.set_body_from_stream(attachment.stream)
 
         p.add_part(attachment_part, order=order, inline=True)
         _user.contact.avatar = attachment_part
@@ -265,6 +265,7 @@ def edit(_user):
         if old_tags != new_tags:
             changed.append('tags')
             _user.contact.interests = tag_objects
+            _user.contact.rebuild_feed()
 
     p.add_part(
         order=0,
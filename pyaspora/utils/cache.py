@@ -0,0 +1,104 @@
+"""
+A simple thread-safe in-process LRU cache, sized from the application
+configuration.
+"""
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from flask import current_app
+from threading import Lock
+from time import time
+
+
+class LRUCache(object):
+    """
+    Keeps up to <size_setting> (an application config key, defaulting to
+    <default_size>) entries, discarding the least-recently-used. A size of 0
+    disables the cache. If <ttl_setting> is given, entries also expire after
+    that many seconds (defaulting to <default_ttl>).
+    """
+
+    def __init__(self, size_setting, default_size, ttl_setting=None,
+                 default_ttl=None):
+        self.size_setting = size_setting
+        self.default_size = default_size
+        self.ttl_setting = ttl_setting
+        self.default_ttl = default_ttl
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+    def _config(self, name, default):
+        try:
+            return current_app.config.get(name, default)
+        except RuntimeError:  # No application context
+            return default
+
+    def get(self, key):
+        """
+        Return a 1-tuple of the cached value for <key>, or None if it has not
+        been cached. (The value itself may be None.)
+        """
+        now = time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and (entry[0] is None or entry[0] > now):
+                self.entries[key] = entry  # most recently used
+                self.counters['hits'] += 1
+                return entry[1]
+            self.counters['misses'] += 1
+            return None
+
+    def put(self, key, value):
+        """
+        Cache <value> for <key>.
+        """
+        size = self._config(self.size_setting, self.default_size)
+        if not size:
+            return
+        expires = None
+        if self.ttl_setting:
+            expires = time() + \
+                self._config(self.ttl_setting, self.default_ttl)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, (value,))
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        return entry is not None and (entry[0] is None or entry[0] > time())
+
+    def discard(self, match):
+        """
+        Discard all entries whose key <match>(key) returns true for.
+        """
+        with self.lock:
+            for key in [k for k in self.entries if match(k)]:
+                del self.entries[key]
+
+    def clear(self):
+        """
+        Discard everything in the cache.
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Counters and sizes suitable for serialisation.
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = float(stats['hits']) / lookups if lookups \
+            else None
+        return stats
@@ -0,0 +1,276 @@
+"""
+A shared HTTP client for talking to other servers. It keeps up to
+HTTP_POOL_SIZE idle connections open to each host between requests, so that
+repeated traffic to the same server doesn't pay for a new TCP connection and
+TLS handshake every time, and applies the same User-Agent and HTTP_TIMEOUT to
+every request. Like urlopen(), it goes through the proxies set in the
+http_proxy and https_proxy environment variables, except for hosts listed in
+no_proxy.
+"""
+from __future__ import absolute_import
+
+from base64 import b64encode
+from flask import current_app
+from io import BytesIO
+from select import select
+from socket import error as socket_error
+from threading import Lock
+try:
+    from http.client import HTTPConnection, HTTPException, HTTPSConnection
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import unquote, urljoin, urlsplit, urlunsplit
+    from urllib.request import getproxies, proxy_bypass
+except:
+    from httplib import HTTPConnection, HTTPException, HTTPSConnection
+    from urllib import getproxies, proxy_bypass, unquote
+    from urllib2 import HTTPError, URLError
+    from urlparse import urljoin, urlsplit, urlunsplit
+
+# Our user agent
+USER_AGENT = 'Pyaspora/0.x'
+
+DEFAULT_TIMEOUT = 20
+DEFAULT_POOL_SIZE = 4
+MAX_REDIRECTS = 5
+
+# Methods that can safely be sent twice, so can be retried if a pooled
+# connection fails after the request might have reached the server
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class _SendError(Exception):
+    """
+    Wraps an error raised while writing a request, before the server can have
+    acted on it.
+    """
+
+    def __init__(self, error):
+        super(_SendError, self).__init__(error)
+        self.error = error
+
+
+def _is_dropped(conn):
+    """
+    Whether the idle connection <conn> has been closed by the server (or has
+    unexpected data waiting), so shouldn't be used.
+    """
+    if conn.sock is None:
+        return True
+    try:
+        return bool(select([conn.sock], [], [], 0)[0])
+    except (ValueError, socket_error):
+        return True
+
+
+def _proxy_for(scheme, host):
+    """
+    The proxy to use for <scheme> requests to <host>, from the environment,
+    as (netloc, Proxy-Authorization header or None), or None to connect
+    directly.
+    """
+    proxy = getproxies().get(scheme)
+    if not proxy or proxy_bypass(host):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    parts = urlsplit(proxy)
+    auth = None
+    if parts.username is not None:
+        auth = 'Basic ' + b64encode('{0}:{1}'.format(
+            unquote(parts.username), unquote(parts.password or '')
+        ).encode('utf-8')).decode('ascii')
+    return parts.netloc.rpartition('@')[2], auth
+
+
+class Response(object):
+    """
+    A completely-read HTTP response. It can be read like a file, and offers
+    the same info(), geturl() and code as the responses from urlopen(), plus
+    the list of URLs that redirected to it in <redirected_via>.
+    """
+
+    def __init__(self, url, status, reason, headers, body, redirected_via):
+        self.url = url
+        self.code = self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.redirected_via = redirected_via
+        self.fp = BytesIO(body)
+
+    def read(self, size=-1):
+        return self.fp.read(size)
+
+    def readlines(self):
+        return self.fp.readlines()
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        self.fp.close()
+
+
+class HTTPClient(object):
+    """
+    Makes HTTP/HTTPS requests over pooled keep-alive connections. It is safe
+    to share between threads; each connection is only used by one request
+    at a time.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pools = {}
+
+    def _config(self, name, default):
+        try:
+            return current_app.config.get(name, default)
+        except RuntimeError:  # No application context
+            return default
+
+    def _checkout(self, scheme, netloc, timeout, proxy=None):
+        """
+        Take an idle connection to <netloc> from the pool, or make a new one
+        (through <proxy>, see _proxy_for(), if given). Returns the connection
+        and whether it was reused.
+        """
+        while True:
+            with self.lock:
+                idle = self.pools.get((scheme, netloc))
+                conn = idle.pop() if idle else None
+            if not conn:
+                break
+            if _is_dropped(conn):
+                conn.close()
+                continue
+            conn.timeout = timeout
+            conn.sock.settimeout(timeout)
+            return conn, True
+
+        if scheme not in ('http', 'https'):
+            raise URLError('Unsupported URL scheme {0}'.format(scheme))
+        if not proxy:
+            conn_class = HTTPSConnection if scheme == 'https' \
+                else HTTPConnection
+            return conn_class(netloc, timeout=timeout), False
+        proxy_netloc, auth = proxy
+        if scheme == 'http':
+            return HTTPConnection(proxy_netloc, timeout=timeout), False
+        conn = HTTPSConnection(proxy_netloc, timeout=timeout)
+        conn.set_tunnel(
+            netloc, headers={'Proxy-Authorization': auth} if auth else None
+        )
+        return conn, False
+
+    def _checkin(self, scheme, netloc, conn):
+        """
+        Return <conn> to the pool for re-use, if there is room for it.
+        """
+        size = self._config('HTTP_POOL_SIZE', DEFAULT_POOL_SIZE)
+        with self.lock:
+            idle = self.pools.setdefault((scheme, netloc), [])
+            if len(idle) < size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _send(self, method, url, body, headers, timeout):
+        """
+        Make a single request (not following redirects). If a pooled
+        connection turns out to have been closed by the server, the request
+        is retried on a fresh connection, but only if the server can't have
+        acted on it already (the request couldn't be written, or is
+        idempotent), so that eg. a Salmon message isn't delivered twice.
+        Returns (status, reason, headers, body).
+        """
+        parts = urlsplit(url)
+        proxy = _proxy_for(parts.scheme, parts.hostname or '')
+        if proxy and parts.scheme == 'http':
+            # Plain HTTP proxies are sent the whole URL
+            path = urlunsplit(parts[:4] + ('',))
+            if proxy[1]:
+                headers = dict(headers, **{'Proxy-Authorization': proxy[1]})
+        else:
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+        while True:
+            conn, reused = self._checkout(parts.scheme, parts.netloc, timeout,
+                                          proxy)
+            try:
+                try:
+                    conn.request(method, path, body, headers)
+                except (HTTPException, socket_error) as e:
+                    raise _SendError(e)
+                resp = conn.getresponse()
+                data = resp.read()
+            except _SendError as e:
+                conn.close()
+                if reused:
+                    continue
+                raise URLError(e.error)
+            except (HTTPException, socket_error) as e:
+                conn.close()
+                if reused and method in IDEMPOTENT_METHODS:
+                    continue
+                raise URLError(e)
+            if resp.will_close:
+                conn.close()
+            else:
+                self._checkin(parts.scheme, parts.netloc, conn)
+            return resp.status, resp.reason, resp.msg, data
+
+    def request(self, method, url, data=None, headers=None, timeout=None):
+        """
+        Make an HTTP request for <url>, following redirects, and return the
+        Response. Raises HTTPError for error statuses and URLError if the
+        server can't be reached, as urlopen() does.
+        """
+        if timeout is None:
+            timeout = self._config('HTTP_TIMEOUT', DEFAULT_TIMEOUT)
+        all_headers = {'User-Agent': USER_AGENT}
+        if data is not None:
+            all_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        all_headers.update(headers or {})
+
+        redirected_via = []
+        while True:
+            status, reason, resp_headers, body = \
+                self._send(method, url, data, all_headers, timeout)
+            location = resp_headers.get('Location')
+            if status in (301, 302, 303, 307, 308) and location:
+                if len(redirected_via) >= MAX_REDIRECTS:
+                    raise URLError('Too many redirects from {0}'.format(url))
+                redirected_via.append(url)
+                url = urljoin(url, location)
+                if status not in (307, 308):
+                    method, data = 'GET', None
+                    all_headers.pop('Content-Type', None)
+                continue
+
+            resp = Response(url, status, reason, resp_headers, body,
+                            redirected_via)
+            if status >= 400:
+                raise HTTPError(url, status, reason, resp_headers, resp)
+            return resp
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def close(self):
+        """
+        Close every idle connection.
+        """
+        with self.lock:
+            pools, self.pools = self.pools, {}
+        for idle in pools.values():
+            for conn in idle:
+                conn.close()
+
+
+http_client = HTTPClient()
@@ -0,0 +1,125 @@
+"""
+Keyset ("cursor") pagination of feeds. Feeds are sorted newest-first on a
+thread modification time, with the Post ID as a tie-breaker, and a cursor
+records the position of a Post in that ordering. Fetching a page is then a
+range read from the cursor, however far down the feed the user has scrolled.
+
+SQLite keeps times as text, in whichever precision they were written: a
+default of now() is stored to the second, but a time from Python to the
+microsecond. Sort keys are compared through comparable_time() so that the
+same instant always compares equal, whichever way it was written.
+"""
+from __future__ import absolute_import
+
+from dateutil.parser import parse as parse_datetime
+from flask import request, url_for
+from sqlalchemy import DateTime
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import and_, asc, desc, literal, or_
+from sqlalchemy.sql.expression import FunctionElement
+
+from pyaspora.utils.rendering import abort
+
+
+class comparable_time(FunctionElement):
+    """
+    The time <expression> in a form that sorts and compares consistently.
+    Other databases have a real timestamp type, so this is the expression
+    itself.
+    """
+    type = DateTime()
+    name = 'comparable_time'
+
+
+@compiles(comparable_time)
+def _comparable_time(element, compiler, **kw):
+    return compiler.process(element.clauses, **kw)
+
+
+@compiles(comparable_time, 'sqlite')
+def _comparable_time_sqlite(element, compiler, **kw):
+    return "strftime('%Y-%m-%d %H:%M:%f', {0})".format(
+        compiler.process(element.clauses, **kw)
+    )
+
+
+def make_cursor(when, item_id):
+    """
+    Build the cursor string for an item sorted by (<when>, <item_id>).
+    """
+    return '{0}_{1}'.format(when.isoformat(), item_id)
+
+
+def parse_cursor(cursor):
+    """
+    Turn a cursor from make_cursor() back into a (datetime, id) pair, or None
+    if no cursor is supplied.
+    """
+    if not cursor:
+        return None
+    try:
+        when, item_id = cursor.rsplit('_', 1)
+        return parse_datetime(when), int(item_id)
+    except (ValueError, OverflowError):
+        abort(400, 'Invalid cursor')
+
+
+def keyset_page(query, sort_column, id_column, limit):
+    """
+    Fetch one page of <query>, which is sorted newest first on
+    (<sort_column>, <id_column>). The 'before' and 'after' request parameters
+    select the items older or newer than the given cursor. The rows are
+    returned as a list, newest first.
+
+    <sort_column> must never be NULL, or those rows could never be paged to;
+    coalesce a nullable column with one that is always set.
+    """
+    before = parse_cursor(request.args.get('before'))
+    after = parse_cursor(request.args.get('after'))
+    sort_key = comparable_time(sort_column)
+
+    if after:
+        when, item_id = after
+        when = comparable_time(literal(when, DateTime()))
+        rows = query.filter(or_(
+            sort_key > when,
+            and_(sort_key == when, id_column > item_id)
+        )).order_by(asc(sort_key), asc(id_column)).limit(limit).all()
+        rows.reverse()
+        return rows
+
+    if before:
+        when, item_id = before
+        when = comparable_time(literal(when, DateTime()))
+        query = query.filter(or_(
+            sort_key < when,
+            and_(sort_key == when, id_column < item_id)
+        ))
+    return query.order_by(desc(sort_key), desc(id_column)). \
+        limit(limit).all()
+
+
+def page_actions(endpoint, rows, cursor_for, limit, **url_args):
+    """
+    Build the 'more' (older items) and 'newer' links for a page of <rows>
+    fetched with keyset_page(). <cursor_for> turns a row into the
+    (datetime, id) pair it is sorted by, and <url_args> are passed to url_for
+    along with the cursor.
+    """
+    actions = {}
+    if not rows:
+        return actions
+
+    url_args.update({'limit': limit, '_external': True})
+    paging_back = 'before' in request.args
+    paging_forward = 'after' in request.args
+
+    oldest = make_cursor(*cursor_for(rows[-1]))
+    if len(rows) >= limit or paging_forward:
+        actions['more'] = url_for(endpoint, before=oldest, **url_args)
+
+    newest = make_cursor(*cursor_for(rows[0]))
+    if paging_back or (paging_forward and len(rows) >= limit):
+        actions['newer'] = url_for(endpoint, after=newest, **url_args)
+
+    return actions
@@ -1,16 +1,49 @@
 from __future__ import absolute_import
 
+from calendar import timegm
 from datetime import datetime
 from dateutil.tz import tzlocal, tzutc
-from flask import jsonify, make_response, render_template, request, url_for, \
-    abort as flask_abort, redirect as flask_redirect
+from flask import current_app, jsonify, make_response, render_template, \
+    request, url_for, abort as flask_abort, redirect as flask_redirect
 from lxml import etree
+from os.path import getmtime, getsize
 from time import mktime
+from werkzeug.wsgi import wrap_file
 from wsgiref.handlers import format_date_time
 
 
 ACCEPTABLE_BROWSER_IMAGE_FORMATS = ('image/jpeg', 'image/gif', 'image/png')
 
+# Bytes read at a time when streaming a file
+BLOB_CHUNK_SIZE = 64 * 1024
+
+# Keys of a response that a sparse fieldset (see select_fields) always keeps
+ALWAYS_SELECTED = ('status', 'code', 'errors')
+
+# Stands in for this server's scheme and host in output that is cached and
+# shared between requests (see portable_url())
+PORTABLE_ROOT = 'urn:x-pyaspora:root'
+
+
+def portable_url(endpoint, **values):
+    """
+    An absolute URL for <endpoint>, like url_for(..., _external=True), but
+    with the scheme and host left as a placeholder, for output that is cached
+    and shared between requests made to different hosts. localise_urls()
+    fills the placeholder in.
+    """
+    return PORTABLE_ROOT + url_for(endpoint, **values)
+
+
+def localise_urls(text):
+    """
+    <text> with the placeholders from portable_url() replaced with the
+    scheme and host of the current request.
+    """
+    if text and PORTABLE_ROOT in text:
+        text = text.replace(PORTABLE_ROOT, request.host_url.rstrip('/'))
+    return text
+
 
 def _desired_format(default='html'):
     return request.args.get('alt', 'html')
@@ -19,7 +52,11 @@ def _desired_format(default='html'):
 def raw_response(body, mime_type, expiry_delta=None):
     response = make_response(body)
     response.headers['Content-Type'] = mime_type
+    _set_expiry(response, expiry_delta)
+    return response
 
+
+def _set_expiry(response, expiry_delta):
     if expiry_delta:
         response.headers['Expires'] = format_date_time(
             mktime(
@@ -27,6 +64,100 @@ def raw_response(body, mime_type, expiry_delta=None):
             )
         )
 
+
+def _read_range(path, start, end, chunk_size=BLOB_CHUNK_SIZE):
+    """
+    Generate the bytes from <start> up to (not including) <end> of the file
+    at <path>, a chunk at a time.
+    """
+    with open(path, 'rb') as blob:
+        blob.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = blob.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def blob_response(mime_type, etag, body=None, path=None, expiry_delta=None,
+                  last_modified=None):
+    """
+    Return a blob of content, which is either <body> (bytes, or a function
+    returning them, which is only called if the body is needed) or the file
+    at <path>. <last_modified> is a datetime, defaulting to the time the
+    file was modified. Conditional requests (If-None-Match,
+    If-Modified-Since) are answered with 304 Not Modified and Range requests
+    with 206 Partial Content. Files are streamed rather than read into
+    memory, using the server's wsgi.file_wrapper (or X-Sendfile, if Flask's
+    USE_X_SENDFILE is set) where possible.
+    """
+    if last_modified is not None:
+        last_modified = timegm(
+            ensure_timezone(last_modified, tz=tzutc()).utctimetuple()
+        )
+    elif path:
+        last_modified = int(getmtime(path))
+
+    not_modified = etag in request.if_none_match
+    if not request.if_none_match and last_modified and \
+            request.if_modified_since:
+        not_modified = \
+            timegm(request.if_modified_since.utctimetuple()) >= last_modified
+    if not_modified:
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        _set_expiry(response, expiry_delta)
+        return response
+
+    if path:
+        size = getsize(path)
+    else:
+        if callable(body):
+            body = body()
+        size = len(body)
+
+    start, end, status = 0, size, 200
+    if_range = request.headers.get('If-Range')
+    if request.range and len(request.range.ranges) == 1 and \
+            (not if_range or if_range == '"{0}"'.format(etag)):
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            response = current_app.response_class(status=416)
+            response.headers['Content-Range'] = 'bytes */{0}'.format(size)
+            return response
+        start, end = byte_range
+        status = 206
+
+    if not path:
+        response = current_app.response_class(body[start:end], status=status)
+    elif status == 200 and current_app.use_x_sendfile:
+        response = current_app.response_class(status=200)
+        response.headers['X-Sendfile'] = path
+    elif status == 200:
+        response = current_app.response_class(
+            wrap_file(request.environ, open(path, 'rb'), BLOB_CHUNK_SIZE),
+            direct_passthrough=True
+        )
+    else:
+        response = current_app.response_class(
+            _read_range(path, start, end),
+            status=status,
+            direct_passthrough=True
+        )
+
+    response.headers['Content-Type'] = mime_type
+    response.headers['Content-Length'] = str(end - start)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if status == 206:
+        response.headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+            start, end - 1, size
+        )
+    response.set_etag(etag)
+    if last_modified:
+        response.headers['Last-Modified'] = format_date_time(last_modified)
+    _set_expiry(response, expiry_delta)
     return response
 
 
@@ -49,6 +180,11 @@ def render_response(template_name, data_structure=None, output_format=None):
         data_structure['status'] = 'OK'
 
     if output_format == 'json':
+        if request.args.get('fields'):
+            data_structure = select_fields(
+                data_structure,
+                request.args['fields'].split(',')
+            )
         response = make_response(jsonify(data_structure))
         response.output_format = 'json'
         return response
@@ -59,6 +195,39 @@ def render_response(template_name, data_structure=None, output_format=None):
         return response
 
 
+def select_fields(data, fields):
+    """
+    Prune the data structure <data> down to the dotted paths in <fields> (eg.
+    "feed.parts.body.text"), for sparse JSON responses. Lists are pruned
+    item-by-item, so paths don't mention them. The request status and any
+    errors are always kept.
+    """
+    tree = {}
+    for path in fields + list(ALWAYS_SELECTED):
+        node = tree
+        steps = path.strip().split('.')
+        for step in steps[:-1]:
+            node = node.setdefault(step, {})
+            if node is None:  # Ancestor already selected in full
+                break
+        else:
+            node[steps[-1]] = None
+
+    def _prune(value, selected):
+        if selected is None:
+            return value
+        if isinstance(value, list):
+            return [_prune(v, selected) for v in value]
+        if isinstance(value, dict):
+            return dict(
+                (k, _prune(value[k], sub)) for k, sub in selected.items()
+                if k in value
+            )
+        return value
+
+    return _prune(data, tree)
+
+
 def abort(status_code, message, extra={}, force_status=False,
           template=None):
     if not template:
@@ -0,0 +1,102 @@
+"""
+Shared set-up for the tests. Each test runs inside a request context against
+a fresh SQLite database in a temporary directory.
+"""
+from __future__ import absolute_import
+
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from pyaspora import app, init_db
+from pyaspora.database import db
+
+_keys = {}
+
+
+def _test_key():
+    # Generating keys is slow, so every test user shares one
+    if 'key' not in _keys:
+        from Crypto.PublicKey import RSA
+        _keys['key'] = RSA.generate(1024)
+    return _keys['key']
+
+
+def _clear_caches():
+    # The in-process caches are keyed on database IDs, which every test's
+    # fresh database reuses
+    from pyaspora.content.cache import render_cache
+    from pyaspora.content.views import part_permissions
+    from pyaspora.feed.cache import feed_cache
+    from pyaspora.post.cache import post_fragments
+    for cache in (render_cache, part_permissions, feed_cache, post_fragments):
+        cache.clear()
+
+
+class AppTestCase(unittest.TestCase):
+    """
+    Base class for tests that need the application and a database. Settings
+    in <config> are applied for the duration of each test.
+    """
+    config = {}
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.saved_config = dict(app.config)
+        app.config.update({
+            'TESTING': True,
+            'SECRET_KEY': 'test',
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' +
+            os.path.join(self.tmpdir, 'test.sqlite'),
+        })
+        app.config.update(self.config)
+        self.app = app
+        self.context = app.test_request_context()
+        self.context.push()
+        init_db()
+        _clear_caches()
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine(app).dispose()
+        self.context.pop()
+        app.config.clear()
+        app.config.update(self.saved_config)
+        rmtree(self.tmpdir)
+
+    def make_contact(self, name='Test'):
+        from pyaspora.contact.models import Contact
+        contact = Contact(realname=name, public_key='-')
+        db.session.add(contact)
+        return contact
+
+    def make_post(self, author, parent=None, public=True, **kwargs):
+        """
+        A Post by <author>, shared on their wall if <public>.
+        """
+        from pyaspora.post.models import Post, Share
+        post = Post(author=author, parent=parent, **kwargs)
+        db.session.add(Share(contact=author, post=post, public=public))
+        return post
+
+    def make_user(self, name='Test', email='test@example.com'):
+        from pyaspora.user.models import User
+        contact = self.make_contact(name)
+        contact.public_key = _test_key().publickey().exportKey().decode()
+        user = User(contact=contact)
+        user.email = email
+        user.private_key = '-'
+        return user
+
+    def client_for(self, user):
+        """
+        A test client logged in as <user>, which must have been committed.
+        """
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user.id
+            session['key'] = _test_key().exportKey(
+                passphrase=self.app.secret_key
+            ).decode()
+        return client
@@ -0,0 +1,182 @@
+from __future__ import absolute_import
+
+import socket
+import sys
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from time import sleep
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from unittest.mock import patch
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from mock import patch
+
+from pyaspora.database import db
+from pyaspora.diaspora.delivery import claim_pending, deliver_all, \
+    deliver_pending
+from pyaspora.diaspora.models import DiasporaContact, MessageQueue
+from tests.base import AppTestCase
+
+
+def _unused_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class _StubPod(ThreadingMixIn, HTTPServer):
+    """
+    Accepts anything POSTed to it after a short delay, recording the most
+    deliveries it saw in progress at once.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _StubPodHandler)
+        self.lock = Lock()
+        self.in_progress = self.max_in_progress = 0
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/'.format(self.server_address[1])
+
+
+class _StubPodHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        pod = self.server
+        with pod.lock:
+            pod.in_progress += 1
+            pod.max_in_progress = max(pod.max_in_progress, pod.in_progress)
+        self.rfile.read(int(self.headers['Content-Length']))
+        sleep(0.05)
+        with pod.lock:
+            pod.in_progress -= 1
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class DeliverAllTest(AppTestCase):
+    config = {'DELIVERY_WORKERS': 10, 'DELIVERY_PER_HOST': 2}
+
+    def setUp(self):
+        super(DeliverAllTest, self).setUp()
+        self.pods = [_StubPod(), _StubPod()]
+        self.dead = 'http://127.0.0.1:{0}/'.format(_unused_port())
+
+    def tearDown(self):
+        for pod in self.pods:
+            pod.shutdown()
+            pod.server_close()
+        super(DeliverAllTest, self).tearDown()
+
+    def deliveries(self):
+        urls = [self.pods[0].url] * 6 + [self.pods[1].url] * 3 + \
+            [self.dead] * 2
+        return [(i, url + 'receive/public', b'envelope')
+                for i, url in enumerate(urls)]
+
+    def check_results(self, deliveries, results):
+        self.assertEqual(sorted(d[0] for d in deliveries),
+                         sorted(r.target for r in results))
+        for result in results:
+            self.assertEqual(self.dead not in result.url, result.sent)
+
+    def test_per_host_limit(self):
+        deliveries = self.deliveries()
+        self.check_results(deliveries, deliver_all(deliveries))
+        self.assertEqual(2, self.pods[0].max_in_progress)
+        self.assertTrue(self.pods[1].max_in_progress <= 2)
+
+    def test_thread_fallback(self):
+        deliveries = self.deliveries()
+        with patch.dict(sys.modules, {'pyaspora.diaspora.engine': None}):
+            results = deliver_all(deliveries)
+        self.check_results(deliveries, results)
+
+
+class QueueTest(AppTestCase):
+
+    def make_remote(self, server):
+        contact = self.make_contact('Remote')
+        db.session.add(DiasporaContact(
+            contact=contact,
+            guid='guid{0}'.format(id(contact)),
+            username='remote{0}@example.com'.format(id(contact)),
+            server=server
+        ))
+        return contact
+
+    def queue(self, remote, created_at=None, last_attempted_at=None):
+        item = MessageQueue.queue_outgoing(remote, b'envelope')
+        if created_at:
+            item.created_at = created_at
+        item.last_attempted_at = last_attempted_at
+        return item
+
+    def test_two_workers_claim_each_message_once(self):
+        remote = self.make_remote('http://pod.example/')
+        items = [self.queue(remote) for _ in range(20)]
+        db.session.commit()
+        ids = set(i.id for i in items)
+
+        start = Event()
+        claimed = []
+
+        def _worker():
+            with self.app.app_context():
+                start.wait()
+                claimed.append(claim_pending(len(ids)))
+
+        workers = [Thread(target=_worker) for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        start.set()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(2, len(claimed))
+        self.assertEqual(ids, set(claimed[0]) | set(claimed[1]))
+        self.assertFalse(set(claimed[0]) & set(claimed[1]))
+        self.assertEqual([], claim_pending(len(ids)))
+
+    def test_retried_after_five_minutes(self):
+        remote = self.make_remote('http://pod.example/')
+        now = datetime.now()
+        recent = self.queue(remote, last_attempted_at=now -
+                            timedelta(minutes=4))
+        due = self.queue(remote, last_attempted_at=now -
+                         timedelta(minutes=6))
+        db.session.commit()
+        self.assertEqual([due.id], claim_pending(10))
+        self.assertNotIn(recent.id, claim_pending(10))
+
+    def test_failed_messages_are_dropped_after_a_day(self):
+        server = 'http://127.0.0.1:{0}/'.format(_unused_port())
+        remote = self.make_remote(server)
+        now = datetime.now()
+        young = self.queue(remote)
+        old = self.queue(remote, created_at=now - timedelta(days=2),
+                         last_attempted_at=now - timedelta(minutes=10))
+        db.session.commit()
+        young_id, old_id = young.id, old.id
+
+        self.assertEqual((0, 2, 0), deliver_pending())
+        remaining = db.session.query(MessageQueue).all()
+        self.assertEqual([young_id], [i.id for i in remaining])
+        self.assertTrue(remaining[0].error)
+        self.assertIsNotNone(remaining[0].last_attempted_at)
+        self.assertNotIn(old_id, claim_pending(10))
@@ -0,0 +1,62 @@
+from __future__ import absolute_import
+
+from json import loads
+
+from pyaspora.content.models import MimePart
+from pyaspora.database import db
+from pyaspora.feed.models import FeedItem
+from tests.base import AppTestCase
+
+
+class FeedItemTest(AppTestCase):
+
+    def _stored_times(self):
+        return db.session.execute(
+            'SELECT feed_items.updated_at, posts.thread_modified_at '
+            'FROM feed_items JOIN posts ON posts.id = feed_items.post_id'
+        ).fetchall()
+
+    def test_rebuild_stores_the_same_sort_key_as_add(self):
+        contact = self.make_contact()
+        post = self.make_post(contact)
+        db.session.flush()
+        post.thread_modified()
+        FeedItem.add(post, [contact.id])
+        db.session.commit()
+        added = self._stored_times()
+
+        FeedItem.rebuild_for_contact(contact)
+        db.session.commit()
+        rebuilt = self._stored_times()
+
+        self.assertEqual(1, len(rebuilt))
+        self.assertEqual(added, rebuilt)
+        self.assertEqual(rebuilt[0][0], rebuilt[0][1])
+
+
+class FeedChangesTest(AppTestCase):
+
+    def test_polling_returns_every_body_format(self):
+        user = self.make_user()
+        db.session.commit()
+        client = self.client_for(user)
+        watermark = loads(client.get('/feed/?since=').data.decode('utf-8'))[
+            'watermark'
+        ]
+        self.assertTrue(watermark)
+
+        post = self.make_post(user.contact)
+        part = MimePart(type='text/plain', text_preview='hello')
+        part.body = b'hello'
+        post.add_part(part, inline=True)
+        db.session.flush()
+        post.thread_modified()
+        FeedItem.add(post, [user.contact_id])
+        db.session.commit()
+
+        response = client.get('/feed/', query_string={'since': watermark})
+        changes = loads(response.data.decode('utf-8'))
+        self.assertEqual([post.id], [p['id'] for p in changes['feed']])
+        body = changes['feed'][0]['parts'][0]['body']
+        self.assertEqual('hello', body['text'])
+        self.assertTrue(body['html'])
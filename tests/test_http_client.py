@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+
+import os
+import unittest
+from threading import Thread
+try:
+    from socketserver import StreamRequestHandler, ThreadingTCPServer
+    from unittest.mock import patch
+    from urllib.error import URLError
+except ImportError:
+    from SocketServer import StreamRequestHandler, ThreadingTCPServer
+    from mock import patch
+    from urllib2 import URLError
+
+from pyaspora.utils.http_client import HTTPClient
+
+
+class _Handler(StreamRequestHandler):
+    """
+    Answers the first request on each connection, keeping the connection
+    open, then reads the next request and drops the connection without
+    answering, as a server timing out an idle connection might.
+    """
+
+    def handle(self):
+        answered = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            headers = {}
+            while True:
+                header = self.rfile.readline().strip()
+                if not header:
+                    break
+                name, _, value = header.decode('ascii').partition(':')
+                headers[name.lower()] = value.strip()
+            self.rfile.read(int(headers.get('content-length', 0)))
+            self.server.requests.append(line.decode('ascii').strip())
+            if answered:
+                return
+            self.wfile.write(
+                b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+            )
+            answered = True
+
+
+class HTTPClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingTCPServer(('127.0.0.1', 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{0}/'.format(
+            self.server.server_address[1]
+        )
+        self.client = HTTPClient()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_idempotent_request_is_retried(self):
+        self.client.get(self.url)
+        self.assertEqual(b'ok', self.client.get(self.url).read())
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_post_is_not_sent_twice(self):
+        self.client.get(self.url)
+        self.assertRaises(URLError, self.client.post, self.url, b'message')
+        self.assertEqual(1, len(
+            [r for r in self.server.requests if r.startswith('POST')]
+        ))
+
+    def test_proxy_from_the_environment(self):
+        proxy = {'http_proxy': self.url, 'no_proxy': '', 'NO_PROXY': ''}
+        with patch.dict(os.environ, proxy):
+            self.client.get('http://pod.example/receive')
+        self.assertEqual(['GET http://pod.example/receive HTTP/1.1'],
+                         self.server.requests)
@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+
+from datetime import datetime, timedelta
+try:
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    from urlparse import parse_qs, urlsplit
+
+from pyaspora.database import db
+from pyaspora.post.models import Post
+from pyaspora.utils.pagination import keyset_page, page_actions
+from tests.base import AppTestCase
+
+
+class KeysetPageTest(AppTestCase):
+
+    def _pages(self, sort_column, cursor_for, limit):
+        """
+        The IDs on each page of all Posts, following the 'more' links.
+        """
+        pages = []
+        args = {}
+        while len(pages) < 20:
+            with self.app.test_request_context('/', query_string=args):
+                rows = keyset_page(db.session.query(Post), sort_column,
+                                   Post.id, limit)
+                pages.append([p.id for p in rows])
+                actions = page_actions('tags.feed', rows, cursor_for, limit,
+                                       tag_name='test')
+            if 'more' not in actions:
+                return pages
+            args = parse_qs(urlsplit(actions['more']).query)
+        self.fail('Paging did not finish: {0}'.format(pages))
+
+    def test_rows_in_the_same_second(self):
+        # A default of now() is stored to the second by SQLite
+        author = self.make_contact()
+        for _ in range(7):
+            self.make_post(author)
+        db.session.commit()
+
+        pages = self._pages(Post.created_at, lambda p: (p.created_at, p.id),
+                            3)
+        self.assertEqual([[7, 6, 5], [4, 3, 2], [1]], pages)
+
+    def test_mixed_precision_and_unmodified_threads(self):
+        author = self.make_contact()
+        old = datetime.utcnow() - timedelta(days=1)
+        for i in range(6):
+            post = self.make_post(author)
+            if i % 2:
+                post.thread_modified_at = old.replace(microsecond=0) + \
+                    timedelta(microseconds=i)
+        db.session.commit()
+
+        pages = self._pages(Post.Queries.thread_sort_key(),
+                            lambda p: (p.thread_sort_time, p.id), 2)
+        ids = [i for page in pages for i in page]
+        self.assertEqual([5, 3, 1, 6, 4, 2], ids)
+
+    def test_newer_link(self):
+        author = self.make_contact()
+        for _ in range(5):
+            self.make_post(author)
+        db.session.commit()
+
+        first = Post.get(5)
+        with self.app.test_request_context('/', query_string={
+            'after': '{0}_{1}'.format(first.created_at.isoformat(), 2)
+        }):
+            rows = keyset_page(db.session.query(Post), Post.created_at,
+                               Post.id, 10)
+        self.assertEqual([5, 4, 3], [p.id for p in rows])
@@ -0,0 +1,68 @@
+from __future__ import absolute_import
+
+import socket
+from threading import Thread
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.error import URLError
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib2 import URLError
+
+from pyaspora.database import db
+from pyaspora.diaspora.models import PodHealth
+from tests.base import AppTestCase
+
+
+class _OK(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+def _unused_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class PodHealthTest(AppTestCase):
+    config = {'POD_FAILURE_THRESHOLD': 1}
+
+    def test_failure_is_recorded_when_the_caller_rolls_back(self):
+        # The request's session holds SQLite's write lock while fetching
+        self.make_contact()
+        db.session.flush()
+        url = 'http://127.0.0.1:{0}/'.format(_unused_port())
+        self.assertRaises(URLError, PodHealth.fetch, url)
+        db.session.rollback()
+
+        health = db.session.query(PodHealth).get(url)
+        self.assertEqual(1, health.failures)
+        self.assertTrue(health.is_open())
+        self.assertRaises(URLError, PodHealth.fetch, url)
+
+    def test_success_is_recorded_for_a_new_server(self):
+        server = HTTPServer(('127.0.0.1', 0), _OK)
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+            self.assertEqual(b'ok', PodHealth.fetch(url).read())
+        finally:
+            server.shutdown()
+            server.server_close()
+        db.session.commit()
+
+        health = db.session.query(PodHealth).get(url)
+        self.assertEqual(0, health.failures)
+        self.assertIsNotNone(health.last_success_at)
@@ -0,0 +1,57 @@
+from __future__ import absolute_import
+
+from json import loads
+
+from flask import url_for
+
+from pyaspora.content.models import MimePart
+from pyaspora.database import db
+from pyaspora.post.views import json_posts
+from pyaspora.tag.models import Tag
+from tests.base import AppTestCase
+
+
+class CommentsTest(AppTestCase):
+    config = {'COMMENTS_PER_THREAD': 5}
+
+    def test_more_comments_is_the_next_page(self):
+        # All in the same second, as SQLite stores now()
+        author = self.make_contact()
+        root = self.make_post(author)
+        comments = [self.make_post(author, parent=root) for _ in range(8)]
+        db.session.commit()
+
+        data = json_posts([(root, None)])[0]
+        shown = [c['id'] for c in data['children']]
+        self.assertEqual([c.id for c in comments[3:]], shown)
+
+        more = data['actions']['more_comments']
+        response = self.app.test_client().get(more + '&alt=json')
+        self.assertEqual(200, response.status_code)
+        page = loads(response.data.decode('utf-8'))
+        self.assertEqual([c.id for c in comments[:3]],
+                         [c['id'] for c in page['comments']])
+        self.assertNotIn('more', page['actions'])
+
+
+class PostFragmentsTest(AppTestCase):
+
+    def test_cached_fragments_link_to_the_requested_host(self):
+        author = self.make_contact()
+        post = self.make_post(author)
+        part = MimePart(type='image/png', text_preview='picture')
+        part.body = b'not really a PNG'
+        post.add_part(part, inline=False)
+        post.tags = Tag.parse_line('kittens', create=True)
+        db.session.commit()
+
+        for host in ('http://one.example/', 'https://two.example/'):
+            with self.app.test_request_context(base_url=host):
+                data = json_posts([(post, None)])[0]
+                raw = url_for('content.raw', part_id=part.id, _external=True)
+                self.assertEqual(raw, data['parts'][0]['link'])
+                self.assertIn(raw, data['parts'][0]['body']['html'])
+                self.assertEqual(
+                    url_for('tags.feed', tag_name='kittens', _external=True),
+                    data['tags'][0]['link']
+                )
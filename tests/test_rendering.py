@@ -0,0 +1,43 @@
+from __future__ import absolute_import
+
+from json import dumps
+
+from flask import url_for
+
+from pyaspora.content.models import MimePart, RenderedPart
+from pyaspora.content.rendering import render, store_rendering
+from pyaspora.database import db
+from tests.base import AppTestCase
+
+
+class RenderTest(AppTestCase):
+
+    def _share_part(self):
+        author = self.make_contact('Author')
+        post = self.make_post(self.make_contact('Sharer'))
+        db.session.flush()
+        part = MimePart(type='application/x-pyaspora-share', text_preview='')
+        part.body = dumps({
+            'author': {'id': author.id, 'name': 'Author'}
+        }).encode('utf-8')
+        post.add_part(part, inline=True)
+        db.session.commit()
+        return post.parts[0], author
+
+    def test_cached_rendering_links_to_the_requested_host(self):
+        part, author = self._share_part()
+        for host in ('http://one.example/', 'https://two.example/'):
+            with self.app.test_request_context(base_url=host):
+                profile = url_for('contacts.profile', contact_id=author.id,
+                                  _external=True)
+                self.assertIn(profile, render(part, 'text/html'))
+
+    def test_stored_rendering_does_not_include_the_host(self):
+        part, author = self._share_part()
+        with self.app.test_request_context(base_url='http://one.example/'):
+            store_rendering(part)
+            db.session.commit()
+        stored = RenderedPart.get_for_parts([part.mime_part.id]). \
+            filter(RenderedPart.format == 'text/html').one()
+        self.assertTrue(stored.body)
+        self.assertNotIn('one.example', stored.body)